@@ -0,0 +1,136 @@
+# sounds, fonts and rendered text for pts.py. nothing is loaded at startup: sounds come in
+# on a background thread, or when first played if that gets there first,
+# and the font when first drawn with. decoded sounds are kept on disk in
+# the mixer's own format and the font's path is remembered, so later
+# launches skip the decode and the system font scan
+import collections
+import json
+import os
+import struct
+import threading
+
+import pygame
+
+from profiler import Profiler
+
+# group => the .wav files it picks from
+SOUNDS = {
+    "spawn": ["spawn"],
+    "die": ["die", "die2"],
+    "hi": ["hi", "hi2"],
+    "attack": ["attack", "attack2"],
+    "recall": ["recall", "recall2"],
+    "alert": ["alert", "alert2"],
+    "spot": ["spot"],
+    }
+
+# cached sound header: source mtime_ns and size, then the mixer's frequency,
+# format and channels. the raw samples follow
+CACHE_HEADER = struct.Struct("<qqiii")
+
+class Assets:
+  def __init__(self, directory=".", cache="asset_cache"):
+    # cache: directory under directory to keep decoded sounds in, None for
+    # nothing on disk
+    self.directory = directory
+    self.cache = cache and os.path.join(directory, cache)
+    self.sounds = {}  # file name => pygame.mixer.Sound
+    self.fonts = {}  # (name, size) => pygame.font.Font
+    self.lock = threading.Lock()  # held while a sound loads
+    self.thread = None
+    self.profiler = Profiler()  # load times, and how many came from the cache
+
+  def start(self):
+    # load every sound on a background thread, most often played first
+    self.thread = threading.Thread(target=self.load_all, daemon=True)
+    self.thread.start()
+
+  def load_all(self):
+    start = self.profiler.start()
+    for names in SOUNDS.values():
+      for name in names:
+        self.sound(name)
+    self.profiler.stop("all sounds", start)
+
+  def sound(self, name):
+    sound = self.sounds.get(name)
+    if sound is None:
+      with self.lock:
+        sound = self.sounds.get(name)
+        if sound is None:
+          start = self.profiler.start()
+          sound = self.sounds[name] = self.load(name)
+          self.profiler.stop("sound", start)
+    return sound
+
+  def load(self, name):
+    path = os.path.join(self.directory, name + ".wav")
+    stat = os.stat(path)
+    frequency, format, channels = pygame.mixer.get_init()
+    header = CACHE_HEADER.pack(stat.st_mtime_ns, stat.st_size, frequency, format, channels)
+    if self.cache:
+      cached = os.path.join(self.cache, name + ".pcm")
+      try:
+        with open(cached, "rb") as f:
+          data = f.read()
+        if data[:CACHE_HEADER.size] == header:
+          self.profiler.count("sounds cached", 1)
+          return pygame.mixer.Sound(buffer=data[CACHE_HEADER.size:])
+      except FileNotFoundError:
+        pass
+    sound = pygame.mixer.Sound(path)
+    if self.cache:
+      # written beside and renamed over, so a crash can't leave half a file
+      os.makedirs(self.cache, exist_ok=True)
+      with open(cached + ".tmp", "wb") as f:
+        f.write(header)
+        f.write(sound.get_raw())
+      os.replace(cached + ".tmp", cached)
+    return sound
+
+  def font(self, name, size):
+    # pygame.font.SysFont(name, size), minus the font scan once the path is
+    # in the cache
+    font = self.fonts.get((name, size))
+    if font is None:
+      start = self.profiler.start()
+      font = self.fonts[(name, size)] = pygame.font.Font(self.font_path(name), size)
+      self.profiler.stop("font", start)
+    return font
+
+  def font_path(self, name):
+    paths = {}
+    index = self.cache and os.path.join(self.cache, "fonts.json")
+    if index and os.path.exists(index):
+      with open(index) as f:
+        paths = json.load(f)
+    if name in paths and (paths[name] is None or os.path.exists(paths[name])):
+      return paths[name]
+    # None means the default font, same as SysFont when there's no match
+    paths[name] = pygame.font.match_font(name)
+    if index:
+      os.makedirs(self.cache, exist_ok=True)
+      with open(index, "w") as f:
+        json.dump(paths, f, indent=2)
+    return paths[name]
+
+class TextCache:
+  # lines of text rendered in font, by content, so a line that's still on
+  # screen isn't rendered again every frame. the least recently drawn go
+  # once there are more than size
+  def __init__(self, font, color=(255, 255, 255), size=256):
+    self.font = font
+    self.color = color
+    self.size = size
+    self.height = font.get_height()
+    self.surfaces = collections.OrderedDict()  # text => pygame.Surface
+
+  def render(self, text):
+    surface = self.surfaces.get(text)
+    if surface is None:
+      surface = self.surfaces[text] = self.font.render(text, True, self.color)
+      if len(self.surfaces) > self.size:
+        self.surfaces.popitem(last=False)
+    else:
+      self.surfaces.move_to_end(text)
+    return surface
@@ -0,0 +1,83 @@
+# sound cues for pts.py on a fixed set of mixer channels. cues of a kind
+# that come in before the next flush() are played as one, louder and in
+# more layers the more of them there were, faded and panned by how far from
+# the focal point they happened. a clash where hundreds die costs what one
+# death does
+import math
+import random
+import time
+
+import pygame
+
+from assets import SOUNDS
+
+# kind => (channels, least seconds between cues, volume)
+KINDS = {
+    "spawn": (1, 0.25, 0.5),
+    "die": (3, 0.1, 0.8),
+    "hi": (1, 0, 1.0),
+    "attack": (1, 0, 1.0),
+    "recall": (1, 0, 1.0),
+    "alert": (1, 0.5, 1.0),
+    "spot": (1, 0.5, 1.0),
+    }
+
+class Audio:
+  def __init__(self, assets, focal, map_w, map_h):
+    self.assets = assets
+    self.focal = focal
+    self.reach = math.hypot(map_w, map_h)  # anything this far off is at its quietest
+    self.channels = {}  # kind => its channels
+    pygame.mixer.set_num_channels(sum(channels for channels, _, _ in KINDS.values()))
+    first = 0
+    for kind, (channels, _, _) in KINDS.items():
+      self.channels[kind] = [pygame.mixer.Channel(first + i) for i in range(channels)]
+      first += channels
+    self.started = {}  # channel => time.perf_counter() its cue started, to take the oldest
+    self.last = dict.fromkeys(KINDS, 0)  # kind => when it last played
+    # kind => [cues, sum of x offsets from focal, nearest distance], since
+    # it last played
+    self.pending = {}
+
+  def cue(self, kind, pos=None):
+    # pos None for something that isn't anywhere, like a click
+    dx = dy = 0
+    if pos is not None:
+      dx, dy = pos[0] - self.focal[0], pos[1] - self.focal[1]
+    distance = math.sqrt(dx * dx + dy * dy)
+    pending = self.pending.get(kind)
+    if pending is None:
+      self.pending[kind] = [1, dx, distance]
+    else:
+      pending[0] += 1
+      pending[1] += dx
+      pending[2] = min(pending[2], distance)
+
+  def flush(self):
+    # play what's been cued, once a frame. a kind cued again too soon
+    # keeps adding up until it's allowed to play
+    now = time.perf_counter()
+    for kind, (cues, dx, nearest) in list(self.pending.items()):
+      channels, interval, volume = KINDS[kind]
+      if now - self.last[kind] < interval:
+        continue
+      del self.pending[kind]
+      self.last[kind] = now
+      gain = min(1.0, volume * (1 + 0.25 * math.log2(cues)))
+      gain *= max(0.2, 1 - nearest / self.reach)
+      pan = max(-1.0, min(1.0, dx / cues / (self.reach / 2)))
+      left, right = gain * min(1.0, 1 - pan), gain * min(1.0, 1 + pan)
+      names = random.sample(SOUNDS[kind], len(SOUNDS[kind]))
+      for layer in range(min(channels, 1 + int(math.log2(cues)) // 2)):
+        self.play(kind, names[layer % len(names)], left, right, now)
+
+  def play(self, kind, name, left, right, now):
+    # on a free channel of kind's, or else the one that's been going longest
+    channels = self.channels[kind]
+    channel = next((channel for channel in channels if not channel.get_busy()), None)
+    if channel is None:
+      channel = min(channels, key=lambda channel: self.started.get(channel, 0))
+    channel.play(self.assets.sound(name))
+    # after play(), which resets it
+    channel.set_volume(left, right)
+    self.started[channel] = now
@@ -0,0 +1,127 @@
+# play lots of headless AI matches across a process pool and add up who won
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import time
+
+import policy
+import sim
+from headless import make_match
+
+def get_policy(name):
+  # "ai" and "idle" are the stock mixes, any strategy in policy.STRATEGIES
+  # can also be played on its own
+  if name == "ai":
+    return policy.AI
+  if name == "idle":
+    return policy.IDLE
+  if name not in policy.STRATEGIES:
+    raise ValueError("unknown policy " + name)
+  return policy.Policy([policy.STRATEGIES[name]])
+
+def play(match):
+  # one match, start to finish, in whichever worker picked it up
+  sim.DEBUG["MOVES"] = False
+  num_players = len(match["policies"])
+  server, clients = make_match(num_players, match["width"], match["height"],
+      ai_players=range(num_players), seed=match["seed"], event_speed=match["event_speed"])
+  server.spawn_rate = match["spawn_rate"]
+  for client, name in zip(clients, match["policies"]):
+    client.policy = get_policy(name)
+  survived = [0] * num_players  # ticks with at least one unit on the map
+  counts = []  # (tick, units per player) every sample_every ticks
+  start = time.perf_counter()
+  for tick in range(match["ticks"]):
+    server.tick()
+    for client in clients:
+      client.tick()
+    alive = collections.Counter(unit.player.index for unit in server.unit_pos)
+    for player in alive:
+      survived[player] += 1
+    if tick % match["sample_every"] == 0 or tick == match["ticks"] - 1:
+      counts.append((server.tick_no, [alive[player] for player in range(num_players)]))
+  final = counts[-1][1]
+  best = max(final)
+  leaders = [player for player in range(num_players) if final[player] == best]
+  return dict(match,
+      winner=leaders[0] if len(leaders) == 1 else None,
+      kills=[server.kills[player] for player in range(num_players)],
+      losses=[server.losses[player] for player in range(num_players)],
+      survived=survived,
+      counts=counts,
+      elapsed=time.perf_counter() - start)
+
+def matches(seeds, sizes, event_speeds, spawn_rates, policies, ticks, sample_every):
+  # every combination of the parameters, once per seed
+  for seed, (width, height), event_speed, spawn_rate in itertools.product(
+      seeds, sizes, event_speeds, spawn_rates):
+    yield {
+        "seed": seed,
+        "width": width,
+        "height": height,
+        "event_speed": event_speed,
+        "spawn_rate": spawn_rate,
+        "policies": policies,
+        "ticks": ticks,
+        "sample_every": sample_every,
+        }
+
+def summarize(results, policies):
+  played = len(results)
+  wins = collections.Counter(result["winner"] for result in results)
+  print("{} matches".format(played))
+  for player, name in enumerate(policies):
+    print("  player {} ({:<8}) won {:>4} ({:5.1%})  kills {:8.1f}  losses {:8.1f}  survived {:8.1f} ticks".format(
+        player, name, wins[player], wins[player] / played,
+        sum(result["kills"][player] for result in results) / played,
+        sum(result["losses"][player] for result in results) / played,
+        sum(result["survived"][player] for result in results) / played))
+  print("  draws {:>4} ({:5.1%})".format(wins[None], wins[None] / played))
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--seeds", type=int, default=100, help="matches per combination")
+  parser.add_argument("--first-seed", type=int, default=0)
+  parser.add_argument("--sizes", default="100x100", help="comma separated WxH")
+  parser.add_argument("--event-speeds", default=str(sim.event_speed), help="comma separated")
+  parser.add_argument("--spawn-rates", default="50", help="comma separated, ticks between spawns")
+  parser.add_argument("--policies", default="ai,ai",
+                      help="one per player: ai, idle or one of " + ", ".join(policy.STRATEGIES))
+  parser.add_argument("--ticks", type=int, default=2000)
+  parser.add_argument("--sample-every", type=int, default=100, help="ticks between unit counts")
+  parser.add_argument("--workers", type=int, help="default one per CPU")
+  parser.add_argument("--out", metavar="PATH", help="write each result as a JSON line")
+  args = parser.parse_args()
+  policies = args.policies.split(",")
+  for name in policies:
+    if name not in ("ai", "idle") and name not in policy.STRATEGIES:
+      parser.error("unknown policy " + name)
+  sizes = [tuple(int(n) for n in size.split("x")) for size in args.sizes.split(",")]
+  jobs = list(matches(
+      range(args.first_seed, args.first_seed + args.seeds), sizes,
+      [int(n) for n in args.event_speeds.split(",")],
+      [int(n) for n in args.spawn_rates.split(",")],
+      policies, args.ticks, args.sample_every))
+  out = open(args.out, "w") if args.out else None
+  results = []
+  start = time.perf_counter()
+  with multiprocessing.Pool(args.workers) as pool:
+    # results come back as matches finish, not in the order they went in
+    for result in pool.imap_unordered(play, jobs):
+      results.append(result)
+      print("[{}/{}] seed {} {}x{} event_speed {} spawn_rate {}: winner {} units {}".format(
+          len(results), len(jobs), result["seed"], result["width"], result["height"],
+          result["event_speed"], result["spawn_rate"], result["winner"], result["counts"][-1][1]))
+      if out:
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+  if out:
+    out.close()
+  elapsed = time.perf_counter() - start
+  print("{:.1f}s, {:.0f} matches/minute".format(elapsed, len(results) / elapsed * 60))
+  summarize(results, policies)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,192 @@
+# seeded simulation workloads, timed per subsystem and compared against a
+# saved baseline
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import policy
+import sim
+from headless import make_match
+
+SUBSYSTEMS = ["spawn_phase", "move_phase", "execute_moves", "expand_commands",
+              "deliver_events", "apply_batch"]
+
+def charge(client, xs, ys, times, rng):
+  # straight at the other side of the map
+  dy = -1 if client.player.spawnpoint[1] >= client.map_h // 2 else 1
+  return rng.integers(-1, 2, len(xs)), np.full(len(xs), dy)
+
+CHARGE = policy.Policy([charge])
+
+def fill(server, player, count, x0, y0, x1, y1):
+  # spawn count units for player on random free squares of the rectangle
+  squares = [(x, y) for x in range(x0, x1) for y in range(y0, y1)]
+  for pos in random.sample(squares, min(count, len(squares))):
+    server.spawn(server.new_unit(player), pos)
+
+def idle(seed):
+  server, clients = make_match(2, 100, 100, seed=seed)
+  return server, clients, None
+
+def clash(seed):
+  # 500 a side in two blocks either side of the middle, running at each other
+  server, clients = make_match(2, 100, 100, seed=seed)
+  for client in clients:
+    client.policy = CHARGE
+  fill(server, server.players[0], 500, 25, 52, 75, 62)
+  fill(server, server.players[1], 500, 25, 38, 75, 48)
+  return server, clients, None
+
+def storm(seed):
+  # one side of 600 units getting a fresh order from somewhere every tick
+  server, clients = make_match(2, 200, 200, seed=seed)
+  player = server.players[0]
+  fill(server, player, 600, 40, 120, 160, 180)
+  def orders(server):
+    units = list(server.unit_pos.items())
+    picked = dict(random.sample(units, min(200, len(units))))
+    waypoints = [(random.randrange(200), random.randrange(200)) for _ in range(3)]
+    origin = (random.randrange(200), random.randrange(200))
+    server.broadcast_command(sim.Command(player, picked, waypoints), origin)
+  return server, clients, orders
+
+def large(seed):
+  # 2000 a side scattered over a 1000x1000 map
+  server, clients = make_match(2, 1000, 1000, seed=seed)
+  for client in clients:
+    client.policy = CHARGE
+  fill(server, server.players[0], 2000, 0, 500, 1000, 1000)
+  fill(server, server.players[1], 2000, 0, 0, 1000, 500)
+  return server, clients, None
+
+SCENARIOS = {
+    "idle": (idle, 2000),
+    "clash": (clash, 300),
+    "storm": (storm, 300),
+    "large": (large, 200),
+    }
+
+def instrument(server, clients, totals, peaks):
+  # wrap each subsystem to add up its time and, if tracemalloc is on, the
+  # most memory it had allocated at once
+  def wrap(name, f):
+    def timed(*args):
+      tracing = tracemalloc.is_tracing()
+      if tracing:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+      start = time.perf_counter()
+      result = f(*args)
+      totals[name] += time.perf_counter() - start
+      if tracing:
+        peaks[name] = max(peaks[name], tracemalloc.get_traced_memory()[1] - before)
+      return result
+    return timed
+  for name in SUBSYSTEMS[:-1]:
+    setattr(server, name, wrap(name, getattr(server, name)))
+  for client in clients:
+    client.apply_batch = wrap("apply_batch", client.apply_batch)
+
+def run(name, seed, ticks, totals, peaks):
+  # one pass over the scenario from scratch, returns the final server and
+  # the seconds its ticks took
+  build, _ = SCENARIOS[name]
+  random.seed(seed)
+  server, clients, per_tick = build(seed)
+  instrument(server, clients, totals, peaks)
+  start = time.perf_counter()
+  for _ in range(ticks):
+    if per_tick:
+      per_tick(server)
+    server.tick()
+    for client in clients:
+      client.tick()
+  return server, time.perf_counter() - start
+
+def measure(name, seed, ticks, memory):
+  # timed without tracemalloc, which slows everything down; peak memory
+  # comes from a second pass over the same seeded scenario
+  ticks = ticks or SCENARIOS[name][1]
+  totals = dict.fromkeys(SUBSYSTEMS, 0.0)
+  peaks = dict.fromkeys(SUBSYSTEMS, 0)
+  server, elapsed = run(name, seed, ticks, totals, peaks)
+  result = {
+      "ticks": ticks,
+      "ticks_per_s": ticks / elapsed,
+      "ms_per_tick": {name: totals[name] * 1000 / ticks for name in SUBSYSTEMS},
+      "units": len(server.unit_pos),
+      }
+  if memory:
+    tracemalloc.start()
+    run(name, seed, ticks, dict.fromkeys(SUBSYSTEMS, 0.0), peaks)
+    tracemalloc.stop()
+    result["peak_kb"] = {name: peaks[name] / 1024 for name in SUBSYSTEMS}
+  return result
+
+def report(name, result, baseline, tolerance):
+  # prints the result next to the baseline, returns how many got worse
+  regressions = 0
+  def row(label, value, old, floor, higher_is_better=False):
+    # floor: below this either way the difference is just noise
+    nonlocal regressions
+    text = "  {:<22} {:>10.3f}".format(label, value)
+    if old:
+      change = value / old - 1
+      worse = -change if higher_is_better else change
+      text += "  {:>+7.1%}".format(change)
+      if worse > tolerance and max(value, old) > floor:
+        text += "  REGRESSION"
+        regressions += 1
+    print(text)
+  old = baseline.get(name, {})
+  print("{} ({} ticks, {} units left)".format(name, result["ticks"], result["units"]))
+  row("ticks/s", result["ticks_per_s"], old.get("ticks_per_s"), 0, higher_is_better=True)
+  for subsystem in SUBSYSTEMS:
+    row(subsystem + " ms/tick", result["ms_per_tick"][subsystem],
+        old.get("ms_per_tick", {}).get(subsystem), 0.05)
+  for subsystem in SUBSYSTEMS if "peak_kb" in result else []:
+    row(subsystem + " peak KB", result["peak_kb"][subsystem],
+        old.get("peak_kb", {}).get(subsystem), 16)
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("scenarios", nargs="*", help="any of " + ", ".join(SCENARIOS))
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--ticks", type=int, help="override every scenario's tick count")
+  parser.add_argument("--memory", action="store_true",
+                      help="also measure peak memory per subsystem, in a second pass")
+  parser.add_argument("--baseline", default="bench_baseline.json")
+  parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+  parser.add_argument("--tolerance", type=float, default=0.2,
+                      help="how much worse than the baseline counts as a regression")
+  args = parser.parse_args()
+  for name in args.scenarios:
+    if name not in SCENARIOS:
+      parser.error("unknown scenario " + name)
+  args.scenarios = args.scenarios or list(SCENARIOS)
+  sim.DEBUG["MOVES"] = False  # both sides spawn, at the real rate
+  baseline = {}
+  if os.path.exists(args.baseline) and not args.save:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+  results = {}
+  regressions = 0
+  for name in args.scenarios:
+    results[name] = measure(name, args.seed, args.ticks, args.memory)
+    regressions += report(name, results[name], baseline, args.tolerance)
+  if args.save:
+    with open(args.baseline, "w") as f:
+      json.dump(results, f, indent=2)
+    print("saved baseline to", args.baseline)
+  elif regressions:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
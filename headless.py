@@ -0,0 +1,63 @@
+# run the simulation without pygame, as fast as the CPU allows
+import argparse
+import time
+
+import replay
+import sim
+
+def make_match(num_players, map_w, map_h, ai_players=None, seed=None, server=None, event_speed=None):
+  # player 0 is the idle "human" side unless told otherwise, like in pts.py.
+  # server can be a fresh sim.Server subclass to set up instead. event_speed
+  # overrides sim.event_speed; it has to be known before the clients are
+  # set up
+  if ai_players is None:
+    ai_players = range(1, num_players)
+  if server is None:
+    server = sim.Server()
+  clients = [sim.Client() for _ in range(num_players)]
+  server.setup(num_players, map_w, map_h, clients, seed)
+  if event_speed is not None:
+    server.event_speed = event_speed
+  for i, client in enumerate(clients):
+    client.setup(server.players[i], map_w, map_h, ai=i in ai_players, event_speed=server.event_speed)
+  return server, clients
+
+def run(server, clients, ticks, recorder=None):
+  start = time.perf_counter()
+  for _ in range(ticks):
+    if recorder:
+      recorder.keyframe()
+    server.tick()
+    for client in clients:
+      client.tick()
+  return time.perf_counter() - start
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--ticks", type=int, default=1000)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--width", type=int, default=100)
+  parser.add_argument("--height", type=int, default=100)
+  parser.add_argument("--players", type=int, default=2)
+  parser.add_argument("--profile", metavar="PATH", help="write tick timings as JSON")
+  parser.add_argument("--record", metavar="PATH", help="record the match for replay.py")
+  parser.add_argument("--keyframe-every", type=int, default=500)
+  args = parser.parse_args()
+  sim.DEBUG["MOVES"] = False  # every player spawns, at the real rate
+  server, clients = make_match(args.players, args.width, args.height, seed=args.seed)
+  recorder = None
+  if args.record:
+    recorder = replay.Recorder(args.record, server, clients, args.keyframe_every)
+  elapsed = run(server, clients, args.ticks, recorder)
+  if recorder:
+    recorder.close()
+  units = len(server.unit_pos)
+  print("{} ticks in {:.3f}s ({:.0f} ticks/s), {} units alive".format(
+      args.ticks, elapsed, args.ticks / elapsed, units))
+  if args.profile:
+    for line in server.profiler.lines():
+      print(line)
+    server.profiler.dump(args.profile)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,121 @@
+# debug lines, kept in a fixed-size ring for the overlay and written out to
+# stdout (and a file, if given one) in batches by a background thread, so
+# logging never waits on the terminal. each line has a level and a channel,
+# and either can be turned down
+import atexit
+import collections
+import os
+import sys
+import threading
+import time
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+
+Line = collections.namedtuple("Line", "serial time level channel text")
+
+class Logger:
+  def __init__(self, size=256, level=DEBUG, stream=sys.stdout, flush_every=0.1):
+    self.lines = collections.deque(maxlen=size)  # the last size Lines
+    self.serial = 0  # lines logged so far; Line.serial counts from 1
+    self.last = 0  # time.monotonic() of the last line
+    self.level = level  # lines below this are dropped
+    self.channels = {}  # channel => False to drop its lines, anything missing is on
+    # once() keys, oldest first, capped so long sessions don't pile them up
+    self.seen = collections.OrderedDict()
+    self.max_seen = 1024
+    self.stream = stream
+    self.file = None
+    self.flush_every = flush_every  # seconds between writes, 0 to write each line as it comes
+    self.outbox = []  # text not written out yet
+    self.lock = threading.Lock()
+    self.write_lock = threading.Lock()  # so batches go out in the order they were taken
+    self.writer = None  # thread, started by the first line
+    atexit.register(self.flush)
+    if hasattr(os, "register_at_fork"):
+      os.register_at_fork(after_in_child=self.forked)
+
+  def log(self, level, channel, *args):
+    if level < self.level or not self.channels.get(channel, True):
+      return
+    text = " ".join(str(a) for a in args)
+    now = time.monotonic()
+    with self.lock:
+      self.serial += 1
+      self.lines.append(Line(self.serial, now, level, channel, text))
+      self.last = now
+      self.outbox.append((now, level, channel, text))
+      if self.flush_every and self.writer is None:
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+    if not self.flush_every:
+      self.flush()
+
+  def debug(self, channel, *args):
+    self.log(DEBUG, channel, *args)
+
+  def info(self, channel, *args):
+    self.log(INFO, channel, *args)
+
+  def warning(self, channel, *args):
+    self.log(WARNING, channel, *args)
+
+  def error(self, channel, *args):
+    self.log(ERROR, channel, *args)
+
+  def once(self, key, level, channel, *args):
+    # log it unless the same key and text came up recently
+    text = " ".join(str(a) for a in args)
+    with self.lock:
+      if (key, text) in self.seen:
+        return
+      self.seen[(key, text)] = None
+      if len(self.seen) > self.max_seen:
+        self.seen.popitem(last=False)
+    self.log(level, channel, text)
+
+  def tail(self, n):
+    # the last n Lines, oldest first
+    with self.lock:
+      return list(self.lines)[-n:]
+
+  def to_file(self, path):
+    # also write every line from now on to path, with its time, level and
+    # channel
+    self.file = open(path, "a")
+
+  def forked(self):
+    # in a forked child: whatever was waiting is the parent's to write, and
+    # a worker can be killed at any moment (Pool.terminate), so it writes
+    # each line straight away
+    self.lock = threading.Lock()
+    self.write_lock = threading.Lock()
+    self.outbox = []
+    self.writer = None
+    self.flush_every = 0
+
+  def write_loop(self):
+    while True:
+      time.sleep(self.flush_every)
+      self.flush()
+
+  def flush(self):
+    with self.write_lock:
+      with self.lock:
+        outbox, self.outbox = self.outbox, []
+      if not outbox:
+        return
+      self.stream.write("".join(text + "\n" for _, _, _, text in outbox))
+      self.stream.flush()
+      if self.file:
+        self.file.write("".join("{:.3f} {} {}: {}\n".format(
+            when, LEVEL_NAMES.get(level, level), channel, text) for when, level, channel, text in outbox))
+        self.file.flush()
+
+# the one everything logs to
+default = Logger()
+debug = default.debug
+info = default.info
+warning = default.warning
+error = default.error
+once = default.once
@@ -0,0 +1,456 @@
+# server and clients in separate processes, over asyncio streams
+#
+# every message is a type byte and a uint32 length, then the body:
+#   W welcome, server to client: player index, player count, map size,
+#     event_speed, current tick, then every player's spawnpoint
+#   F frame, server to client, one per tick: the tick, how many events, the
+#     smallest event id, then the events as columns (see EVENT_COLUMNS)
+#   C command, client to server: a replay.pack_command record. the server
+#     fills in the player and id itself
+import argparse
+import array
+import asyncio
+import collections
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import headless
+import logger
+import policy
+import replay
+import sim
+from profiler import Profiler
+
+MESSAGE = struct.Struct("<cI")
+WELCOME = struct.Struct("<HHiiHq")
+FRAME = struct.Struct("<qIq")
+
+# an event goes out as a kind and one position plus a step from it: a spawn
+# is the new position, a death the old one, and a move the old one plus
+# the step to the new one, which is never more than one square
+SPAWN, MOVE, DIE = 0, 1, 2
+EVENT_COLUMNS = [
+    ("id", "I", np.uint32),  # event id minus the frame's smallest
+    ("unit", "i", np.int32),
+    ("age", "H", np.uint16),  # frame tick minus event tick, at most a horizon
+    ("player", "B", np.uint8),
+    ("kind", "B", np.uint8),
+    ("x", "h", np.int16),
+    ("y", "h", np.int16),
+    ("dx", "b", np.int8),
+    ("dy", "b", np.int8),
+    ]
+
+def message(kind, body):
+  return MESSAGE.pack(kind, len(body)) + body
+
+async def read_message(reader):
+  # (type, body), or (None, None) once the other end has gone
+  try:
+    kind, size = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+    return kind, await reader.readexactly(size)
+  except (asyncio.IncompleteReadError, ConnectionError):
+    return None, None
+
+def decode_command(server, player, body):
+  # (command, origin) from a C message body for player, ValueError if the
+  # body isn't a whole, playable command
+  try:
+    _, (_, _, formation, origin, waypoints, units), end = replay.unpack_command(body, 0)
+  except (struct.error, IndexError, ValueError) as e:
+    raise ValueError("bad command: {}".format(e))
+  if end != len(body):
+    raise ValueError("bad command: {} bytes, expected {}".format(len(body), end))
+  if not waypoints:
+    raise ValueError("bad command: no waypoints")
+  return replay.make_command(server, player, formation, waypoints, units), origin
+
+class RemoteClient:
+  # stands in for a sim.Client on the server. events for the real one, in
+  # another process, are kept as columns and go out as one frame per tick
+  def __init__(self):
+    self.initialized = False
+
+  def setup(self, player, map_w, map_h, ai=False, event_speed=None):
+    if self.initialized:
+      return
+    self.ai = ai
+    self.policy = policy.AI if ai else policy.IDLE
+    self.player = player
+    self.player_index = player.index
+    self.map_w = map_w
+    self.map_h = map_h
+    self.writer = None  # None until someone connects for this player
+    self.columns = [[] for _ in EVENT_COLUMNS]  # this tick's batches so far, per column
+    self.initialized = True
+
+  def handle_event(self, event):
+    self.apply_batch(sim.event_batch([event]))
+
+  def apply_batch(self, batch):
+    if self.writer is None or not len(batch):
+      return
+    old_xs, old_ys, new_xs, new_ys = batch.positions.T
+    spawn = old_xs < 0
+    die = new_xs < 0
+    move = ~spawn & ~die
+    kinds = np.where(spawn, SPAWN, np.where(die, DIE, MOVE))
+    chunks = [batch.ids, np.array([unit.id for unit in batch.units]), batch.ticks,
+        np.array([unit.player.index for unit in batch.units]), kinds,
+        np.where(spawn, new_xs, old_xs), np.where(spawn, new_ys, old_ys),
+        np.where(move, new_xs - old_xs, 0), np.where(move, new_ys - old_ys, 0)]
+    for column, chunk in zip(self.columns, chunks):
+      column.append(chunk)
+
+  def frame(self, tick):
+    # this tick's events as a frame message, and start on the next one
+    if not self.columns[0]:
+      return message(b"F", FRAME.pack(tick, 0, 0))
+    columns = [np.concatenate(column) if column else np.zeros(0, dtype)
+        for column, (_, _, dtype) in zip(self.columns, EVENT_COLUMNS)]
+    ids = columns[0]
+    base = int(ids.min()) if len(ids) else 0
+    columns[0] = ids - base
+    columns[2] = tick - columns[2]
+    body = [FRAME.pack(tick, len(ids), base)]
+    for (name, _, dtype), column in zip(EVENT_COLUMNS, columns):
+      info = np.iinfo(dtype)
+      if column.min() < info.min or column.max() > info.max:
+        # it would wrap, and the client would get it wrong without knowing
+        raise OverflowError("event {} out of range for {}".format(name, info.dtype))
+      body.append(column.astype(dtype).tobytes())
+    self.columns = [[] for _ in EVENT_COLUMNS]
+    return message(b"F", b"".join(body))
+
+  def tick(self):
+    pass
+
+  def __getstate__(self):
+    # replay keyframes leave the connection behind
+    state = dict(self.__dict__)
+    state["writer"] = None
+    return state
+
+def make_match(num_players, map_w, map_h, remote, ai_players=(), seed=None):
+  # like headless.make_match, but the players in remote are played from
+  # other processes
+  server = sim.Server()
+  clients = [RemoteClient() if i in remote else sim.Client() for i in range(num_players)]
+  server.setup(num_players, map_w, map_h, clients, seed)
+  for i, client in enumerate(clients):
+    client.setup(server.players[i], map_w, map_h, ai=i in ai_players, event_speed=server.event_speed)
+  return server, clients
+
+class NetServer:
+  # ticks the server at a fixed rate once every remote player has
+  # connected, sending each of them a frame per tick. commands they send
+  # back are played on the next tick, like runner.Runner.submit
+  def __init__(self, server, clients, rate=30, recorder=None):
+    self.server = server
+    self.clients = clients
+    self.rate = rate  # ticks per second, 0 to go flat out
+    self.recorder = recorder
+    self.remotes = [client for client in clients if isinstance(client, RemoteClient)]
+    # positions and ages have to fit their EVENT_COLUMNS
+    horizon = sim.ring_radius((0, 0), (server.map_w, server.map_h)) * server.event_speed
+    if max(server.map_w, server.map_h) > np.iinfo(np.int16).max + 1:
+      raise ValueError("maps over {} squares across can't be sent".format(np.iinfo(np.int16).max + 1))
+    if horizon > np.iinfo(np.uint16).max:
+      raise ValueError("event_speed {} is too slow to send on a {}x{} map".format(
+          server.event_speed, server.map_w, server.map_h))
+    self.inbox = collections.deque()
+    self.all_connected = asyncio.Event()
+    if not self.remotes:
+      self.all_connected.set()
+    self.handlers = set()  # tasks reading from each connection
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    self.commands = 0  # played from the inbox so far
+
+  async def handle(self, reader, writer):
+    seat = next((remote for remote in self.remotes if remote.writer is None), None)
+    if seat is None:
+      writer.close()
+      return
+    server = self.server
+    seat.writer = writer
+    self.handlers.add(asyncio.current_task())
+    spawnpoints = array.array("h", [n for player in server.players for n in player.spawnpoint])
+    writer.write(message(b"W", WELCOME.pack(seat.player_index, len(server.players),
+        server.map_w, server.map_h, server.event_speed, server.tick_no) + spawnpoints.tobytes()))
+    if all(remote.writer for remote in self.remotes):
+      self.all_connected.set()
+    try:
+      while True:
+        kind, body = await read_message(reader)
+        if kind is None:
+          break
+        self.bytes_received += MESSAGE.size + len(body)
+        if kind == b"C":
+          try:
+            self.inbox.append(decode_command(server, seat.player_index, body))
+          except ValueError as e:
+            # can't trust anything else it sends either
+            logger.warning("net", "dropping player", seat.player_index, e)
+            break
+    finally:
+      # free the seat for someone else
+      seat.writer = None
+      writer.close()
+
+  async def step(self):
+    server = self.server
+    if self.recorder:
+      self.recorder.keyframe()
+    while self.inbox:
+      command, pos = self.inbox.popleft()
+      self.commands += 1
+      if self.recorder:
+        self.recorder.command(command, pos)
+      server.broadcast_command(command, pos)
+    server.tick()
+    start = server.profiler.start()
+    for remote in self.remotes:
+      if remote.writer:
+        frame = remote.frame(server.tick_no)
+        self.bytes_sent += len(frame)
+        remote.writer.write(frame)
+    server.profiler.stop("encode_frames", start)
+    for client in self.clients:
+      client.tick()
+    for remote in self.remotes:
+      if remote.writer:
+        try:
+          await remote.writer.drain()
+        except ConnectionError:
+          remote.writer = None
+
+  async def run(self, ticks=None):
+    await self.all_connected.wait()
+    next_tick = time.perf_counter()
+    while ticks is None or self.server.tick_no < ticks:
+      if self.rate:
+        next_tick += 1 / self.rate
+        await asyncio.sleep(max(0, next_tick - time.perf_counter()))
+      else:
+        # drain() doesn't wait under the high-water mark, so without this
+        # handle() would never get to read what the players send
+        await asyncio.sleep(0)
+      await self.step()
+
+  async def close(self):
+    # hang up on everyone and let their handlers finish
+    for remote in self.remotes:
+      if remote.writer:
+        remote.writer.close()
+    await asyncio.gather(*self.handlers)
+
+  async def serve(self, host, port, ticks=None):
+    listener = await asyncio.start_server(self.handle, host, port)
+    async with listener:
+      await self.run(ticks)
+      await self.close()
+
+class NetClient:
+  # a sim.Client kept up to date from a NetServer's frames
+  def __init__(self):
+    self.client = sim.Client()
+    self.profiler = Profiler()
+    self.unit_cache = {}  # unit id => sim.Unit, for units still alive
+    self.random = random.Random(0)  # skins are only for looks, no need to match
+    self.bytes_received = 0
+    self.events = 0
+    self.tick_no = None
+
+  async def connect(self, host, port):
+    self.reader, self.writer = await asyncio.open_connection(host, port)
+    kind, body = await read_message(self.reader)
+    player_index, num_players, map_w, map_h, event_speed, self.tick_no = WELCOME.unpack_from(body)
+    spawnpoints = array.array("h")
+    spawnpoints.frombytes(body[WELCOME.size:])
+    self.players = [sim.Player(i, (spawnpoints[2 * i], spawnpoints[2 * i + 1]))
+        for i in range(num_players)]
+    self.client.setup(self.players[player_index], map_w, map_h, event_speed=event_speed)
+
+  def unit(self, unit_id, player):
+    unit = self.unit_cache.get(unit_id)
+    if unit is None:
+      unit = self.unit_cache[unit_id] = sim.Unit(self.players[player], unit_id, self.random)
+    return unit
+
+  def apply(self, body):
+    tick, count, base = FRAME.unpack_from(body)
+    self.tick_no = tick
+    if not count:
+      return
+    offset = FRAME.size
+    columns = []
+    for _, _, dtype in EVENT_COLUMNS:
+      column = np.frombuffer(body, dtype, count, offset)
+      offset += column.nbytes
+      columns.append(column)
+    event_ids, unit_ids, ages, players, kinds, xs, ys, dxs, dys = columns
+    order = np.argsort(event_ids, kind="stable")
+    units = [self.unit(unit_id, player)
+        for unit_id, player in zip(unit_ids[order].tolist(), players[order].tolist())]
+    spawn = kinds[order] == SPAWN
+    die = kinds[order] == DIE
+    xs = xs[order].astype(np.int32)
+    ys = ys[order].astype(np.int32)
+    self.client.apply_batch(sim.EventBatch(base + event_ids[order].astype(np.int64),
+        tick - ages[order].astype(np.int64), units, np.column_stack((
+            np.where(spawn, -1, xs), np.where(spawn, -1, ys),
+            np.where(die, -1, xs + dxs[order]), np.where(die, -1, ys + dys[order])))))
+    for unit_id in unit_ids[order][die].tolist():
+      self.unit_cache.pop(unit_id, None)
+    self.events += count
+
+  async def next_frame(self):
+    # wait for the next tick's events and apply them. returns the tick, or
+    # None once the server has gone. client.dead/spawned/moves hold just
+    # this tick's until the next call
+    self.client.tick()
+    kind, body = await read_message(self.reader)
+    while kind is not None and kind != b"F":
+      kind, body = await read_message(self.reader)
+    if kind is None:
+      return None
+    self.bytes_received += MESSAGE.size + len(body)
+    start = self.profiler.start()
+    self.apply(body)
+    self.profiler.stop("decode", start)
+    return self.tick_no
+
+  def submit(self, command, pos):
+    self.writer.write(message(b"C", replay.pack_command(0, command, pos)))
+
+  def close(self):
+    self.writer.close()
+
+async def follow(host, port, ticks=None, command_every=0):
+  # connect and keep up until the server goes or ticks frames have come.
+  # every command_every frames, send all our units somewhere random
+  net_client = NetClient()
+  await net_client.connect(host, port)
+  client = net_client.client
+  frames = 0
+  while ticks is None or frames < ticks:
+    if await net_client.next_frame() is None:
+      break
+    frames += 1
+    if command_every and frames % command_every == 0 and client.units:
+      mine = {unit: pos for unit, pos in client.units.items() if unit.player == client.player}
+      if mine:
+        waypoint = (random.randrange(client.map_w), random.randrange(client.map_h))
+        net_client.submit(sim.Command(client.player, mine, [waypoint]), client.player.spawnpoint)
+  net_client.close()
+  return net_client, frames
+
+def report(net_client, frames, elapsed):
+  p50, p99 = net_client.profiler.percentiles("decode")
+  print("player {}: {} frames, {} events, {} bytes ({:.0f} bytes/s, {:.1f} bytes/event), "
+      "decode p50 {:.3f}ms p99 {:.3f}ms, {} units seen".format(
+      net_client.client.player_index, frames, net_client.events, net_client.bytes_received,
+      net_client.bytes_received / elapsed, net_client.bytes_received / max(1, net_client.events),
+      p50 * 1000, p99 * 1000, len(net_client.client.units)))
+
+async def loopback(args):
+  # server and every remote player in this process, over real sockets on
+  # 127.0.0.1, then the same match played headless to check against. if the
+  # players send commands, the match is recorded and the check is its replay
+  remote = range(args.players)
+  ai_players = range(args.players)
+  server, clients = make_match(args.players, args.width, args.height, remote, ai_players, args.seed)
+  recorder = None
+  if args.command_every:
+    handle, path = tempfile.mkstemp(suffix=".bin")
+    os.close(handle)
+    recorder = replay.Recorder(path, server, clients)
+  net_server = NetServer(server, clients, args.rate, recorder)
+  listener = await asyncio.start_server(net_server.handle, "127.0.0.1", 0)
+  port = listener.sockets[0].getsockname()[1]
+  start = time.perf_counter()
+  async with listener:
+    followers = [asyncio.create_task(follow("127.0.0.1", port, args.ticks, args.command_every))
+        for _ in remote]
+    await net_server.run(args.ticks)
+    results = await asyncio.gather(*followers)
+    await net_server.close()
+  elapsed = time.perf_counter() - start
+  print("{} ticks in {:.2f}s, sent {} bytes, played {} commands".format(
+      args.ticks, elapsed, net_server.bytes_sent, net_server.commands))
+  ok = True
+  if recorder:
+    recorder.close()
+    recording = replay.Recording(path)
+    os.remove(path)
+    reference, reference_clients = recording.start()
+    recording.advance(reference, reference_clients, args.ticks)
+    commanded = sum(unit.last_command_seq >= 0 for unit in server.unit_pos)
+    print("{} of {} units on the map took a command".format(commanded, len(server.unit_pos)))
+    if not net_server.commands or not commanded:
+      print("commands sent from the players never took effect")
+      ok = False
+  else:
+    reference, reference_clients = headless.make_match(
+        args.players, args.width, args.height, ai_players, args.seed)
+    headless.run(reference, reference_clients, args.ticks)
+  for (net_client, frames), expected in zip(results, reference_clients):
+    report(net_client, frames, elapsed)
+    got = sorted((unit.id, pos) for unit, pos in net_client.client.units.items())
+    want = sorted((unit.id, pos) for unit, pos in expected.units.items())
+    if got != want:
+      print("player {}: remote view differs from the headless one".format(expected.player_index))
+      ok = False
+  return ok
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("mode", choices=["serve", "connect", "loopback"])
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=7777)
+  parser.add_argument("--players", type=int, default=2)
+  parser.add_argument("--remote", default="0", help="serve: comma separated players played remotely")
+  parser.add_argument("--ai", default="", help="serve: comma separated players the server plays")
+  parser.add_argument("--width", type=int, default=100)
+  parser.add_argument("--height", type=int, default=100)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--ticks", type=int, default=1000)
+  parser.add_argument("--rate", type=float, default=30, help="ticks per second, 0 for flat out")
+  parser.add_argument("--command-every", type=int, default=0, help="connect, loopback: frames between commands")
+  parser.add_argument("--record", metavar="PATH", help="serve: record the match for replay.py")
+  args = parser.parse_args()
+  sim.DEBUG["MOVES"] = False
+  if args.mode == "serve":
+    remote = [int(i) for i in args.remote.split(",") if i]
+    ai_players = [int(i) for i in args.ai.split(",") if i]
+    server, clients = make_match(args.players, args.width, args.height, remote, ai_players, args.seed)
+    recorder = replay.Recorder(args.record, server, clients) if args.record else None
+    net_server = NetServer(server, clients, args.rate, recorder)
+    print("waiting for players", remote, "on port", args.port)
+    start = time.perf_counter()
+    asyncio.run(net_server.serve(args.host, args.port, args.ticks))
+    if recorder:
+      recorder.close()
+    elapsed = time.perf_counter() - start
+    p50, p99 = server.profiler.percentiles("encode_frames")
+    print("{} ticks, sent {} bytes, received {}, encode p50 {:.3f}ms p99 {:.3f}ms".format(
+        server.tick_no, net_server.bytes_sent, net_server.bytes_received, p50 * 1000, p99 * 1000))
+  elif args.mode == "connect":
+    start = time.perf_counter()
+    net_client, frames = asyncio.run(follow(args.host, args.port, command_every=args.command_every))
+    report(net_client, frames, time.perf_counter() - start)
+  elif not asyncio.run(loopback(args)):
+    sys.exit(1)
+
+if __name__ == "__main__":
+  # through the module, so keyframes pickle RemoteClient as net.RemoteClient
+  # rather than __main__.RemoteClient
+  import net
+  net.main()
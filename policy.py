@@ -0,0 +1,94 @@
+import numpy as np
+
+# a strategy gets the positions and times (ticks alive, counted in moves)
+# of a group of units as arrays, plus the client they belong to and a
+# numpy generator, and returns arrays of dx and dy for all of them
+
+def wander(rng, n):
+  return rng.integers(-1, 2, n)
+
+def facing(client):
+  # strategies are written for a spawn at the top, moving down (+y) towards
+  # the enemy. a player spawning in the bottom half has it the other way
+  # round: flip ys into that frame with depth() and dys back with this
+  return 1 if client.player.spawnpoint[1] < client.map_h // 2 else -1
+
+def depth(client, ys):
+  # how far in from the player's own edge of the map
+  return ys if facing(client) == 1 else client.map_h - 1 - ys
+
+def attacker(client, xs, ys, times, rng):
+  ds = depth(client, ys)
+  dx = wander(rng, len(xs))
+  # move up towards center, then rush in
+  dy = np.where((times < 8) | (times > 20), 1, 0)
+  # too far, go back
+  dy = np.where(ds >= client.map_h - 2, -1, dy)
+  # close in the flanks
+  flank = np.where(xs > client.map_w // 2, -1, 1)
+  dx = np.where(times > 40, flank, dx)
+  return dx, dy * facing(client)
+
+def mid(client, xs, ys, times, rng):
+  ds = depth(client, ys)
+  dx = wander(rng, len(xs))
+  # move to center, then sit there
+  dy = np.where(ds < client.map_h // 2, 1, 0)
+  return dx, dy * facing(client)
+
+def defender(client, xs, ys, times, rng):
+  ds = depth(client, ys)
+  spawn_x, spawn_y = client.player.spawnpoint
+  # sit close to spawn, but out of the lane in front of it, so new units
+  # can still step out and get past
+  near = ds < depth(client, spawn_y) + 2
+  in_lane = np.abs(xs - spawn_x) < 3
+  aside = np.where(xs >= spawn_x, 1, -1)
+  dx = np.where(in_lane, aside, np.where(near, wander(rng, len(xs)), 0))
+  dy = np.where(near | in_lane, 1, 0)
+  return dx, dy * facing(client)
+
+def idle_spawn(client, xs, ys, times, rng):
+  # form near the spawn
+  fan_width = 4
+  fan_depth = 4
+  spawn_y = client.player.spawnpoint[1]
+  if spawn_y >= client.map_h // 2:
+    dy = np.where(ys > spawn_y - fan_depth, -1, 0)
+  else:
+    dy = np.where(ys < spawn_y + fan_depth, 1, 0)
+  in_fan = (xs > client.map_w // 2 - fan_width) & (xs < client.map_w // 2 + fan_width)
+  dx = np.where(in_fan, wander(rng, len(xs)), 0)
+  return dx, dy
+
+# strategy name => strategy, for picking one by name (see batch.py)
+STRATEGIES = {
+    "attacker": attacker,
+    "mid": mid,
+    "defender": defender,
+    "idle_spawn": idle_spawn,
+    }
+
+class Policy:
+  # picks moves for all of a player's units in one call. each unit follows
+  # strategies[strat], where strat comes from strategy_ids()
+  def __init__(self, strategies):
+    self.strategies = strategies
+
+  def strategy_ids(self, unit_ids):
+    return unit_ids % len(self.strategies)
+
+  def moves(self, client, xs, ys, times, strats, rng):
+    dxs = np.zeros(len(xs), dtype=np.int64)
+    dys = np.zeros(len(xs), dtype=np.int64)
+    for strat, strategy in enumerate(self.strategies):
+      mask = strats == strat
+      if not mask.any():
+        continue
+      dx, dy = strategy(client, xs[mask], ys[mask], times[mask], rng)
+      dxs[mask] = dx
+      dys[mask] = dy
+    return dxs, dys
+
+AI = Policy([attacker, mid, defender])
+IDLE = Policy([idle_spawn])
@@ -0,0 +1,64 @@
+import collections
+import json
+import time
+
+class Profiler:
+  # rolling timings per section plus counters. cheap enough to leave on:
+  # a section is two perf_counter() calls and a deque append
+  def __init__(self, window=300):
+    self.window = window
+    self.samples = {}  # section => deque of the last window durations, seconds
+    self.calls = collections.Counter()  # section => times it ran
+    self.counters = {}  # counter => last value
+    self.totals = collections.Counter()  # counter => sum of every value
+
+  def start(self):
+    return time.perf_counter()
+
+  def stop(self, section, start):
+    samples = self.samples.get(section)
+    if samples is None:
+      samples = self.samples[section] = collections.deque(maxlen=self.window)
+    samples.append(time.perf_counter() - start)
+    self.calls[section] += 1
+
+  def count(self, counter, value):
+    self.counters[counter] = value
+    self.totals[counter] += value
+
+  def percentiles(self, section):
+    # (p50, p99) in seconds over the window
+    samples = sorted(self.samples.get(section, ()))
+    if not samples:
+      return (0, 0)
+    return (samples[len(samples) // 2], samples[min(len(samples) - 1, len(samples) * 99 // 100)])
+
+  def lines(self):
+    lines = []
+    for section in list(self.samples):
+      p50, p99 = self.percentiles(section)
+      lines.append("{:<20} p50 {:7.3f}ms p99 {:7.3f}ms".format(section, p50 * 1000, p99 * 1000))
+    for counter, value in list(self.counters.items()):
+      lines.append("{:<20} {}".format(counter, value))
+    return lines
+
+  def summary(self):
+    sections = {}
+    for section in list(self.samples):
+      samples = list(self.samples[section])
+      p50, p99 = self.percentiles(section)
+      sections[section] = {
+          "calls": self.calls[section],
+          "p50_ms": p50 * 1000,
+          "p99_ms": p99 * 1000,
+          "mean_ms": sum(samples) / len(samples) * 1000,
+          "max_ms": max(samples) * 1000,
+          }
+    counters = {}
+    for counter, value in list(self.counters.items()):
+      counters[counter] = {"last": value, "total": self.totals[counter]}
+    return {"sections": sections, "counters": counters}
+
+  def dump(self, path):
+    with open(path, "w") as f:
+      json.dump(self.summary(), f, indent=2)
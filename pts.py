@@ -1,440 +1,40 @@
+import time
+started = time.perf_counter()  # for the startup report
+
 import pygame
-import functools
+import json
 import math
-import random
-import collections
-
-DEBUG = {
-        "MOVES": True,
-        }
-
-event_speed = 5
-
-frame = 0
-terminal_lines = []
-last_print = 0
-messages = set()
-def debug(*args):
-  global last_print
-  text = " ".join(str(a) for a in args)
-  print(text)
-  terminal_lines.append(text)
-  if len(terminal_lines) > 20:
-    terminal_lines.pop(0)
-  last_print = frame
-def udebug(mid, *args):
-  text = " ".join(str(a) for a in args)
-  key = (mid, text)
-  if key in messages:
-    return
-  messages.add(key)
-  debug(text)
-
-def circlegen(center, radius, border=True):
-  # (x-a)^2 + (y-b)^2 = r^2
-  # => y = b +-sqrt(r^2 - (x-a)^2)
-  a = center[0]
-  b = center[1]
-  for x in range(a - radius, a + radius + 1):
-    s = math.sqrt(radius ** 2 - (x - a) ** 2)
-    for y in [b + s, b - s]:
-      y = int(round(y))
-      yield (x, y)
-      # also round inwards
-      # TODO this is jank
-      x2 = x - 1 if x > 0 else x + 1
-      y2 = y - 1 if y > 0 else y + 1
-      yield (x2, y)
-      yield (x, y2)
-      yield (x2, y2)
-
-@functools.cache
-def circle(center, radius, border=True):
-  return list(circlegen(center, radius, border))
-
-class Player:
-  def __init__(self, index, spawnpoint):
-    self.index = index
-    self.spawnpoint = spawnpoint
-
-sid = 0
-class Idd:
-  def __init__(self):
-    global sid
-    self.id = sid
-    sid += 1
-
-  def __hash__(self):
-    return hash(self.id)
-
-  def __eq__(self, other):
-    return self.id == other.id
-
-  def __lt__(self, other):
-    return self.id < other.id
-
-class Unit(Idd):
-  def __init__(self, player):
-    Idd.__init__(self)
-    self.player = player
-    self.personality = random.randint(1, 255)
-    self.skin = (random.randint(1, 255),
-        random.randint(1, 255),
-        random.randint(1, 255))
-    self.active_dst = None
-    self.active_waypoint = None
-    self.active_command = None
-    self.last_command_seq = -1
-    self.time = 0
-
-  def __str__(self):
-    return "[unit id={} player={}]".format(self.id, self.player.index)
-
-  def __repr__(self):
-    return str(self)
-
-  def _formation(self, command, pos):
-    # sort by x, break ties by y
-    sunits= sorted(list(command.units.keys()),
-                   key=lambda unit: (command.units[unit][0], command.units[unit][1]))
-    num_cols = int(math.ceil(1.25 * math.sqrt(len(command.units))))
-    num_rows = len(command.units) // num_cols + 1
-    udebug(command.id, "formation", num_cols, "x", num_rows)
-    formation = {}
-    i = 0
-    for col in range(num_cols):
-      for row in range(num_rows):
-        if i >= len(sunits):
-          break
-        formation[sunits[i]] = (col, row)
-        i += 1
-    spot = formation[self]
-    pos = (pos[0] + spot[0], pos[1] + spot[1])
-    self.active_dst = pos
-
-  def command(self, command):
-    if command.player != self.player or self not in command.units:
-      # ignore commands not meant for me
-      return
-    if command.id <= self.last_command_seq:
-      # ignore stale/duplicate commands
-      return
-    if self.active_command is None or self.active_command != command:
-      self.active_command = command
-      self.active_waypoint = 0
-    pos = command.pos[self.active_waypoint]
-    self._formation(command, pos)
-    self.last_command_seq = command.id
-
-  # form near the spawn
-  def idle_spawn(self, client, pos):
-    fan_width = 4
-    fan_depth = 4
-    dx, dy = 0, 0
-    if self.player.spawnpoint[1] >= client.map_h // 2:
-      if pos[1] > self.player.spawnpoint[1] - fan_depth:
-        dy = -1
-    else:
-      if pos[1] < self.player.spawnpoint[1] + fan_depth:
-        dy = 1
-    if pos[0] > client.map_w // 2 - fan_width and pos[0] < client.map_w // 2 + fan_width:
-      dx = random.randint(-1, 1)
-    return (dx, dy)
-
-  def ai_move(self, client, pos):
-    strat = self.id % 3
-    dy = 0
-    dx = random.randint(-1, 1)
-    time = self.time
-    if strat == 0: # attacker
-      if time < 8 or time > 20:
-        # move up towards center, then rush in
-        dy = 1
-      if pos[1] >= client.map_h - 2:
-        # too far, go back
-        dy = -1
-      if time > 40:
-        # close in the flanks
-        dx = -1 if pos[0] > client.map_w // 2 else 1
-    elif strat == 1: # mid
-      # move to center, then sit there
-      if y < client.map_h // 2:
-        dy = 1
-    elif strat == 2: # defender
-      # sit close to spawn
-      if pos[1] < 5:
-        dy = 1
-      else:
-        dx = 0
-    return (dx, dy)
-
-  def get_move(self, client, pos):
-    self.time += 1
-    if client.ai:
-      return self.ai_move(client, pos)
-    if not self.active_dst:
-      return self.idle_spawn(client, pos)
-    dx, dy = 0, 0
-    if self.active_dst[0] < pos[0]:
-      dx = -1
-    elif self.active_dst[0] > pos[0]:
-      dx = 1
-    if self.active_dst[1] < pos[1]:
-      dy = -1
-    elif self.active_dst[1] > pos[1]:
-      dy = 1
-    if dx == 0 and dy == 0:
-      if self.active_waypoint is not None:
-        self.active_waypoint += 1
-        if self.active_waypoint >= len(self.active_command.pos):
-          self.active_waypoint = None
-          self.active_command = None
-        else:
-          pos = self.active_command.pos[self.active_waypoint]
-          self._formation(self.active_command, pos)
-    return (dx, dy)
-
-class Command(Idd):
-  # units is dict of unit -> selected positions
-  def __init__(self, player, units, pos):
-    Idd.__init__(self)
-    self.player = player
-    self.units = units
-    self.pos = pos
-
-class Event(Idd):
-  # if old_pos is None, the unit is spawning
-  # if new_pos is None, the unit is dying
-  def __init__(self, tick, unit, old_pos, new_pos):
-    Idd.__init__(self)
-    self.tick = tick
-    self.unit = unit
-    self.old_pos = old_pos
-    self.new_pos = new_pos
-
-class Client:
-  def __init__(self):
-    self.initialized = False
-
-  def setup(self, player, map_w, map_h, ai=False):
-    if self.initialized:
-      return
-    self.ai = ai
-    self.player = player
-    self.player_index = player.index
-    self.map_w = map_w
-    self.map_h = map_h
-    self.dead = set()
-    self.spawned = set()
-    self.perma_dead = set()
-    self.units = {}  # unit => position
-    self.map = collections.defaultdict(lambda: set())  # position => units
-    self.seen_events = set()  # IDs
-    self.initialized = True
-
-  def handle_event(self, event):
-    if event.id in self.seen_events:
-      return
-    self.seen_events.add(event.id)
-    if event.unit in self.units:
-      pos = self.units[event.unit]
-      self.map[pos].discard(event.unit)
-      del self.units[event.unit]
-    if event.new_pos and event.unit not in self.perma_dead:
-      if not event.old_pos:
-        # something spawned
-        self.spawned.add(event.new_pos)
-      self.units[event.unit] = event.new_pos
-      self.map[event.new_pos].add(event.unit)
-    if event.old_pos and not event.new_pos:
-      # something died
-      self.dead.add(event.old_pos)
-      self.perma_dead.add(event.unit)
-
-  def tick(self):
-    self.dead.clear()
-    self.spawned.clear()
-
-class Server:
-  def __init__(self):
-    self.initialized = False
-
-  def for_all_squares(self, f):
-    for x in range(self.map_w):
-      for y in range(self.map_h):
-        f(x, y)
-
-  def setup(self, num_players, map_w, map_h, clients):
-    if self.initialized:
-      return
-    self.clients = clients
-    self.event_speed = event_speed
-    self.tick_no = 0
-    self.map_w = map_w
-    self.map_h = map_h
-    self.map = {}
-    self.event_centers = {}  # event => (center point, radius)
-    self.event_map = collections.defaultdict(set)  # point => set of events
-    self.command_centers = {}  # command => (center point, radius)
-    self.command_map = collections.defaultdict(set)  # point => set of commands
-    for x in range(map_w):
-      for y in range(map_h):
-        self.map[(x, y)] = None
-    self.new_map = dict(self.map)
-    self.players = []
-    center = (map_w / 2, map_h / 2)
-    radius = min(map_w, map_h) / 2 * (7 / 8)
-    for player in range(num_players):
-      angle = math.radians(90 + player * 360 / num_players)
-      spawnpoint = (int(center[0] + radius * math.cos(angle)),
-          int(center[1] + radius * math.sin(angle)))
-      self.players.append(Player(player, spawnpoint))
-    self.initialized = True
-
-  def broadcast_event(self, event, pos):
-    self.event_centers[event] = [pos, 0]
 
-  def broadcast_command(self, command, pos):
-    self.command_centers[command] = (pos, 0)
-
-  def expand_events(self):
-    to_delete = []
-    to_expand = []
-    for event, el in self.event_centers.items():
-      center, radius = el
-      for x, y in circle(center, radius):
-        if event in self.event_map[(x, y)]:
-          self.event_map[(x, y)].remove(event)
-      inside = False
-      for x, y in circle(center, radius + 1):
-        if x >= 0 and x < self.map_w and y >= 0 and y < self.map_h:
-          inside = True
-          self.event_map[(x, y)].add(event)
-      if inside:
-        to_expand.append(event)
-      else:
-        to_delete.append(event)
-    for event in to_expand:
-      cr = self.event_centers[event]
-      cr[1] += 1
-    for event in to_delete:
-      del self.event_centers[event]
-
-  def expand_commands(self):
-    to_delete = []
-    to_set = []
-    for command, el in self.command_centers.items():
-      center, radius = el
-      for x, y in circle(center, radius):
-        if command in self.command_map[(x, y)]:
-          self.command_map[(x, y)].remove(command)
-      inside = False
-      for x, y in circle(center, radius + 1):
-        if x >= 0 and x < self.map_w and y >= 0 and y < self.map_h:
-          inside = True
-          self.command_map[(x, y)].add(command)
-          unit = self.map[(x, y)]
-          if unit:
-            unit.command(command)
-      if inside:
-        to_set.append((command, center, radius + 1))
-      else:
-        to_delete.append(command)
-    for command, center, radius in to_set:
-      self.command_centers[command] = (center, radius)
-    for command in to_delete:
-      del self.command_centers[command]
-
-
-  def spawn(self, unit, pos):
-    if not self.map[pos]:
-#      debug("spawning", unit, "at", pos)
-      self.map[pos] = unit
-      self.new_map[pos] = unit
-      self.broadcast_event(Event(self.tick_no, unit, old_pos=None, new_pos=pos), pos)
-
-  def enqueue_move(self, x, y, dx, dy, detour=False):
-    unit = self.map[(x, y)]
-    if not unit:
-      return
-    new_x = max(0, min(x + dx, self.map_w - 1))
-    new_y = max(0, min(y + dy, self.map_h - 1))
-    occupied = self.new_map[(new_x, new_y)]
-    if occupied:
-      if occupied.player.index != unit.player.index:
-        # collide, killing both units
-        #debug("collision at", new_x, new_y)
-        self.new_map[(x, y)] = None
-        self.new_map[(new_x, new_y)] = None
-        self.broadcast_event(Event(self.tick_no, unit,
-          old_pos=(x, y), new_pos=(new_x, new_y)), (new_x, new_y))
-        self.broadcast_event(Event(self.tick_no, unit,
-          old_pos=(new_x, new_y), new_pos=None), (new_x, new_y))
-        self.broadcast_event(Event(self.tick_no, occupied,
-          old_pos=(new_x, new_y), new_pos=None), (new_x, new_y))
-        return
-      if detour:
-        # it's one of our own, just try once to move around it
-        dx = ((dx + 1) % 2) - 1
-        dy = ((dy + 1) % 2) - 1
-        self.enqueue_move(x, y, dx, dy, detour=False)
-      return
-    self.broadcast_event(Event(self.tick_no, unit,
-      old_pos=(x, y), new_pos=(new_x, new_y)), (x, y))
-    self.new_map[(new_x, new_y)] = self.new_map[(x, y)]
-    self.new_map[(x, y)] = None
-
-  def execute_moves(self):
-    self.map = dict(self.new_map)
-
-  def spawn_phase(self):
-    for player in self.players:
-      if DEBUG["MOVES"] and player.index > 0:
-        continue
-      self.spawn(Unit(player), player.spawnpoint)
-
-  def tick(self):
-    move_speed = 10
-    spawn_rate = 50 if DEBUG["MOVES"] else 500
-    if self.tick_no % spawn_rate == 0:
-      self.spawn_phase()
-    def move(x, y):
-      unit = self.map[(x, y)]
-      if not unit:
-        return
-      (dx, dy) = unit.get_move(self.clients[unit.player.index], (x, y))
-      self.enqueue_move(x, y, dx, dy, detour=True)
-    if self.tick_no % move_speed == 0:
-      self.for_all_squares(move)
-    self.execute_moves()
-    if self.tick_no % self.event_speed == 0:
-      self.expand_events()
-      self.expand_commands()
-    for client in self.clients:
-      for event in self.event_map[self.players[client.player_index].spawnpoint]:
-        client.handle_event(event)
-    self.tick_no += 1
+import numpy as np
 
+import sim
+import logger
+from assets import Assets, TextCache
+from audio import Audio
+from profiler import Profiler
+from replay import Recorder
+from runner import Runner
+from sim import Server, Client, Command, FORMATIONS, circle
 
 # pygame setup
+startup = Profiler()  # how long each step took up to the first frame
+startup.stop("imports", started)
+section = startup.start()
 pygame.init()
-font = pygame.font.SysFont("Courier New", 20)
 pygame.mixer.init()
-sounds = lambda names: [pygame.mixer.Sound(d + ".wav") for d in names]
-play_sound = lambda sounds: sounds[random.randint(0, len(sounds) - 1)].play()
-die_sounds = sounds(["die", "die2"])
-attack_sounds = sounds(["attack", "attack2"])
-alert_sounds = sounds(["alert", "alert2"])
-recall_sounds = sounds(["recall", "recall2"])
-hi_sounds = sounds(["hi", "hi2"])
-spawn_sounds = sounds(["spawn"])
-spot_sounds = sounds(["spot"])
+startup.stop("pygame.init", section)
+# sounds load in the background, the font when there's first text to draw
+assets = Assets()
+assets.start()
 RES_X = 720
 RES_Y = 720
+section = startup.start()
 screen = pygame.display.set_mode((RES_X, RES_Y))
+startup.stop("display", section)
 clock = pygame.time.Clock()
 running = True
 dt = 0
+frame = 0
 
 # constants
 fps = 30
@@ -444,25 +44,92 @@ scale = base_scale
 zoom = 1
 margin = int(scale * 0.1)
 
-# gui state
+# the sim runs on its own thread at sim_speed ticks per second, whatever
+# the frame rate
+sim_speed = 30
+section = startup.start()
 server = Server()
 client = Client()
 ai = Client()
+server.setup(2, square_edge, square_edge, [client, ai])
+client.setup(server.players[0], square_edge, square_edge)
+ai.setup(server.players[1], square_edge, square_edge, ai=True)
+recorder = Recorder("replay.bin", server, [client, ai]) if sim.DEBUG["RECORD"] else None
+if sim.DEBUG["LOG"]:
+  logger.default.to_file("debug.log")
+runner = Runner(server, [client, ai], client, sim_speed, recorder)
+runner.start()
+audio = Audio(assets, server.players[0].spawnpoint, square_edge, square_edge)
+startup.stop("sim setup", section)
+
+# gui state
+view = runner.snapshot  # latest tick the renderer has seen
 explosions = {}  # coords => frame
+animations = {}  # unit => (old position, new position, time.perf_counter() it moved)
 last_tick = 0
-sim_speed = 30
 select_start = None
 select_end = None
 selected_units = {}
 selected_pos = None
 waypoints = []
+formation = "grid"
+frame_profiler = Profiler()
+show_profile = False  # P toggles tick and frame timings in the text area
+text = None  # TextCache for the text area, made when there's first something in it
+hidden_lines = 0  # serial of the last log line the text area has dropped
 camera = (0, 0)
 def pos_to_square(pos):
   return ((pos[0] - camera[0]) // scale, (pos[1] - camera[1]) // scale)
 def square_to_pos(square):
   return (square[0] * scale + scale // 2 + camera[0], square[1] * scale + scale // 2 + camera[1])
+def on_screen(x, y):
+  return (-scale < x * scale + camera[0] < RES_X and
+          -scale < y * scale + camera[1] < RES_Y)
+def visible_squares():
+  # (x0, y0, x1, y1) covering everything at least partly on screen
+  return (-camera[0] // scale, -camera[1] // scale,
+          (RES_X - camera[0]) // scale + 1, (RES_Y - camera[1]) // scale + 1)
+
+# the background never changes, so it's drawn once at a pixel per square
+# and scaled up again only when the zoom changes. past max_layer_pixels
+# only the part on screen is scaled, every frame
+max_layer_pixels = 4096 * 4096
+background = None  # one pixel per square
+layer = None  # (scale, background scaled to it)
+def draw_background():
+  xs, ys = np.mgrid[0:server.map_w, 0:server.map_h]
+  distance = np.sqrt((xs - focal[0]) ** 2 + (ys - focal[1]) ** 2)
+  purple = np.maximum((60 - distance * 2).astype(int), 0)
+  pixels = np.stack((purple, (purple * 2 / 3).astype(int), purple), axis=-1)
+  pixels[xs % 2 == ys % 2] = 10
+  surface = pygame.surfarray.make_surface(pixels.astype(np.uint8))
+  for player in server.players:
+    hue = 360 * player.index / len(server.players)
+    color = pygame.Color(0)
+    color.hsva = (int(hue), 35, 100, 100)
+    surface.set_at(player.spawnpoint, color)
+  return surface
+def blit_background():
+  global background, layer
+  if background is None:
+    background = draw_background()
+  if (server.map_w * scale) * (server.map_h * scale) <= max_layer_pixels:
+    if layer is None or layer[0] != scale:
+      layer = (scale, pygame.transform.scale(
+          background, (server.map_w * scale, server.map_h * scale)))
+    screen.blit(layer[1], camera)
+    return
+  x0, y0, x1, y1 = visible_squares()
+  x0, y0 = max(0, x0), max(0, y0)
+  x1, y1 = min(server.map_w, x1), min(server.map_h, y1)
+  if x0 >= x1 or y0 >= y1:
+    return
+  visible = background.subsurface((x0, y0, x1 - x0, y1 - y0))
+  visible = pygame.transform.scale(visible, ((x1 - x0) * scale, (y1 - y0) * scale))
+  screen.blit(visible, (x0 * scale + camera[0], y0 * scale + camera[1]))
 
 while running:
+  section = frame_profiler.start()
   # poll for events
   # pygame.QUIT event means the user clicked X to close your window
   for event in pygame.event.get():
@@ -486,38 +153,45 @@ while running:
         if selected_units: # order move
           dst = pos_to_square(event.pos)
           waypoints.append(dst)
-          debug("waypoint", dst)
+          logger.info("ui", "waypoint", dst)
           if not (pygame.key.get_mods() & pygame.KMOD_SHIFT):
-            command = Command(server.players[0], dict(selected_units), waypoints)
-            server.broadcast_command(command, server.players[0].spawnpoint)
+            command = Command(server.players[0], dict(selected_units), waypoints, formation)
+            runner.submit(command, server.players[0].spawnpoint)
             waypoints = []
             if dst[1] <= selected_pos[1]:
-              play_sound(attack_sounds)
+              audio.cue("attack")
             else:
-              play_sound(recall_sounds)
+              audio.cue("recall")
     elif event.type == pygame.MOUSEBUTTONUP:
       if event.button == 1:      
         if select_start and select_end:
           square_start = pos_to_square(select_start)
           square_end = pos_to_square(select_end)
           selected_units = {}
-          for x in range(min(square_start[0], square_end[0]),
-                         max(square_start[0], square_end[0])):
-            for y in range(min(square_start[1], square_end[1]),
-                           max(square_start[1], square_end[1])):
-              units = client.map[(x, y)]
-              for unit in units:
-                if unit.player.index == 0:
-                  selected_pos = (x, y)
-                  selected_units[unit] = (x, y)
+          min_x = min(square_start[0], square_end[0])
+          max_x = max(square_start[0], square_end[0])
+          min_y = min(square_start[1], square_end[1])
+          max_y = max(square_start[1], square_end[1])
+          hits = view.units.query_rect(min_x, min_y, max_x, max_y)
+          for unit, (x, y) in sorted(hits, key=lambda item: item[1]):
+            if unit.player.index == 0:
+              selected_pos = (x, y)
+              selected_units[unit] = (x, y)
           select_start = None
           select_end = None
           if selected_units:
-              #            debug("selected", len(selected_units), "units")
-            play_sound(hi_sounds)
+              #            logger.info("ui", "selected", len(selected_units), "units")
+            audio.cue("hi")
     elif event.type == pygame.MOUSEMOTION:
       if select_start:
         select_end = event.pos
+    elif event.type == pygame.KEYDOWN:
+      if event.key == pygame.K_f:  # cycle formations
+        shapes = list(FORMATIONS)
+        formation = shapes[(shapes.index(formation) + 1) % len(shapes)]
+        logger.info("ui", "formation", formation)
+      elif event.key == pygame.K_p:
+        show_profile = not show_profile
   keys = pygame.key.get_pressed()
   move_x, move_y = 0, 0
   if keys[pygame.K_w]:
@@ -534,20 +208,28 @@ while running:
 
   # fill the screen with a color to wipe away anything from last frame
   screen.fill("black")
-  
-  server.setup(2, square_edge, square_edge, [client, ai])
-  client.setup(server.players[0], square_edge, square_edge)
-  ai.setup(server.players[1], square_edge, square_edge, ai=True)
-  if frame % (fps // sim_speed) == 0:
-    server.tick()
+  frame_profiler.stop("input", section)
+
+  section = frame_profiler.start()
+  while runner.snapshots:
+    view = runner.snapshots.popleft()
     last_tick = frame
-    for spawned in client.spawned:
-      play_sound(spawn_sounds)
-    for dead in client.dead:
-    #  debug("explosion at", dead, ", frame", frame)
+    for spawned in view.spawned:
+      audio.cue("spawn", spawned)
+    for dead in view.dead:
+    #  logger.debug("ui", "explosion at", dead, ", frame", frame)
       explosions[dead] = frame
-      play_sound(die_sounds)
-    client.tick()
+      audio.cue("die", dead)
+    for unit, old_pos, new_pos in view.moves:
+      animations[unit] = (old_pos, new_pos, time.perf_counter())
+
+  # slide units from their last square to the new one over the time it
+  # takes the sim to move them again
+  move_time = server.move_speed / sim_speed
+  now = time.perf_counter()
+  to_clear = [unit for unit, (_, _, start) in animations.items() if now - start > move_time]
+  for unit in to_clear:
+    del animations[unit]
 
   to_clear = set()
   for k, v in explosions.items():
@@ -556,61 +238,60 @@ while running:
   for k in to_clear:
     del explosions[k]
 
-  spawns = set()
-  for player in server.players:
-    spawns.add(player.spawnpoint)
-    x = player.spawnpoint[0]
-    y = player.spawnpoint[1]
-    hue = 360 * player.index / len(server.players)
-    color = pygame.Color(0)
-    color.hsva = (int(hue), 35, 100, 100)
-    pygame.draw.rect(screen, color, (x * scale + camera[0], y * scale + camera[1], scale, scale))
+  frame_profiler.stop("snapshots", section)
+
+  section = frame_profiler.start()
+  audio.flush()
+  frame_profiler.stop("audio", section)
+
+  section = frame_profiler.start()
   focal = server.players[0].spawnpoint
-  for x in range(server.map_w):
-    for y in range(server.map_h):
-      if (x, y) not in spawns:
-        distance = math.sqrt((x - focal[0]) ** 2 + (y - focal[1]) ** 2)
-        # draw the space
-        purple = max(int(60 - distance * 2), 0)
-        color = (purple, int(purple * 2 / 3), purple)
-        if x % 2 == y % 2:
-          color = (10, 10, 10)
-        pygame.draw.rect(screen, color, (x * scale + camera[0], y * scale + camera[1], scale, scale))
-      if (x, y) in explosions:
-        color = "white"
-        if int(frame - explosions[(x, y)]) % 2 == 0:
-          color = "black"
-        pygame.draw.rect(screen, color, (x * scale + camera[0], y * scale + camera[1], scale, scale))
+  blit_background()
+  for (x, y), start in explosions.items():
+    if not on_screen(x, y):
+      continue
+    color = "white"
+    if int(frame - start) % 2 == 0:
+      color = "black"
+    pygame.draw.rect(screen, color, (x * scale + camera[0], y * scale + camera[1], scale, scale))
 
-      if False:  # edit to show events
-        for event in server.event_map[(x, y)]:
-          if event.new_pos: continue   # explosions only
-          color = (0, 150 - 3 * (event.id % 20), 0)
+  if False:  # edit to show events still on their way to an observer
+    shown = set()
+    for _, index, _ in server.pending_events():
+      event = server.log.event(index)
+      if event.new_pos or event.id in shown: continue   # explosions only
+      shown.add(event.id)
+      color = (0, 150 - 3 * (event.id % 20), 0)
+      radius = server.radius_at(event.tick, server.tick_no - 1)
+      xs, ys = circle(event.old_pos, radius, server.map_w, server.map_h)
+      for x, y in zip(xs.tolist(), ys.tolist()):
+        if on_screen(x, y):
           pygame.draw.rect(screen, color, (x * scale + camera[0], y * scale + camera[1], scale, scale))
 
+  frame_profiler.stop("background", section)
+
+  section = frame_profiler.start()
   for i, pos in enumerate(waypoints):
     x, y = pos
+    if not on_screen(x, y):
+      continue
     color = (0, max(100 - i * 20, 20), 0)
     pygame.draw.rect(screen, color, (x * scale + camera[0], y * scale + camera[1], scale, scale))
 
-  for unit, pos in client.units.items():
+  for unit, pos in view.units.query_rect(*visible_squares()):
     x, y = pos
     distance = math.sqrt((x - focal[0]) ** 2 + (y - focal[1]) ** 2)
     move_x = 0
     move_y = 0
-#    if (x, y) in server.moves:
-#      # animate
-#      old_pos = server.moves[(x, y)]
-#      dx = x - old_pos[0]
-#      dy = y - old_pos[1]
-#      mag = (frame - last_tick) / (fps // sim_speed) - 1.0
-#      move_x = dx * mag * scale
-#      move_y = dy * mag * scale
-#      if False and server.map[(x, y)].id % 20 == 0:
-#        debug("animate",
-#            {"frame": frame, "last_tick": last_tick,
-#              "pos": (x, y), "diff": (dx, dy), "mag": mag,
-#              "move": (move_x, move_y)})
+    if unit in animations:
+      old_pos, new_pos, start = animations[unit]
+      if new_pos == pos:
+        # animate
+        dx = x - old_pos[0]
+        dy = y - old_pos[1]
+        mag = (now - start) / move_time - 1.0
+        move_x = dx * mag * scale
+        move_y = dy * mag * scale
     hue = 360 * unit.player.index / len(server.players) + (unit.skin[0] / 12)
     hue = int(hue) % 360
     color = pygame.Color(0)
@@ -625,6 +306,9 @@ while running:
       scale - margin * 2,
       scale - margin * 2), 0, int(scale / 6))
 
+  frame_profiler.stop("units", section)
+
+  section = frame_profiler.start()
   if select_end:
     select_rect = pygame.Rect(
             min(select_start[0], select_end[0]),
@@ -634,25 +318,44 @@ while running:
     pygame.draw.rect(screen, "white", select_rect, 2)
 
   # animate commands (not to scale)
-  for command, val in server.command_centers.items():
-    center, radius = val
+  for command, center, radius in view.commands:
     if command.player == server.players[0] and radius < 4:
       pos = square_to_pos(center)
       pygame.draw.circle(screen, (0, 100, 0),
                          (pos[0], pos[1]),
                          radius * scale * 2, 1)
 
-  # print debug
-  if len(terminal_lines) > 0 and frame - last_print > fps * 2:
-    terminal_lines.pop(0)
-  for i, line in enumerate(terminal_lines):
-    text_surface = font.render(line, True, (255, 255, 255))
-    screen.blit(text_surface, (10, 10 + i * font.get_height()))
+  # print debug: the last 20 lines, dropping one a frame once nothing's
+  # been logged for a couple of seconds
+  shown = [line for line in logger.default.tail(20) if line.serial > hidden_lines]
+  if shown and time.monotonic() - logger.default.last > 2:
+    hidden_lines = shown.pop(0).serial
+  lines = [line.text for line in shown]
+  if show_profile:
+    lines += server.profiler.lines() + frame_profiler.lines()
+  if lines and text is None:
+    text = TextCache(assets.font("Courier New", 20))
+  for i, line in enumerate(lines):
+    screen.blit(text.render(line), (10, 10 + i * text.height))
+  frame_profiler.stop("overlay", section)
 
   # flip() the display to put your work on screen
+  section = frame_profiler.start()
   pygame.display.flip()
+  frame_profiler.stop("flip", section)
+  if frame == 0:
+    startup.stop("first frame", started)
+    logger.info("startup", "startup: " + ", ".join("{} {:.0f}ms".format(step, samples[-1] * 1000)
+        for step, samples in startup.samples.items()))
 
   dt = clock.tick(fps) / 1000
   frame += 1
 
+runner.stop()
+if recorder:
+  recorder.close()
+if sim.DEBUG["PROFILE"]:
+  with open("profile.json", "w") as f:
+    json.dump({"tick": server.profiler.summary(), "frame": frame_profiler.summary(),
+        "startup": startup.summary(), "assets": assets.profiler.summary()}, f, indent=2)
 pygame.quit()
@@ -0,0 +1,242 @@
+# record a match as its player commands plus the odd keyframe, and play it
+# back headless from any tick
+#
+# file layout, all little endian:
+#   header: magic, version, players, map size, seed, speeds, flags, ai players
+#   then records, each a tag byte and a struct:
+#     C command: tick, id, player, formation, origin, then its waypoints as
+#       int32 pairs and its units as int64 ids, int32 xs, int32 ys
+#     K keyframe: tick, size, then zlib'd pickle of (server, clients)
+#     E end: tick the recording stopped on
+# commands and keyframes for a tick are taken at the start of the tick,
+# before its commands go out
+#
+# keyframes are pickles. they're loaded with only the classes a match is
+# made of allowed in, but that stops a bad file running code, not feeding
+# the sim nonsense: only play back recordings from a source you trust
+import argparse
+import array
+import bisect
+import collections
+import hashlib
+import io
+import pickle
+import struct
+import sys
+import time
+import zlib
+
+import headless
+import policy
+import sim
+
+MAGIC = b"PTSR"
+VERSION = 3  # 3: the server queues events by arrival tick, 2: clients keep seen events as a bitmap
+HEADER = struct.Struct("<4sHHiiqiiiBI")
+COMMAND = struct.Struct("<qqHBiiII")
+KEYFRAME = struct.Struct("<qI")
+END = struct.Struct("<q")
+FORMATIONS = list(sim.FORMATIONS)
+
+DEBUG_MOVES = 1  # header flag: DEBUG["MOVES"] was on
+
+# module => names a keyframe may load. numpy moved its core to numpy._core
+# in 2.0, both spellings are here
+KEYFRAME_GLOBALS = {
+  "array": {"array", "_array_reconstructor"},
+  "collections": {"Counter", "deque"},
+  "random": {"Random"},
+  "numpy": {"dtype"},
+  "numpy.core.multiarray": {"_reconstruct", "scalar"},
+  "numpy._core.multiarray": {"_reconstruct", "scalar"},
+  "numpy.core.numeric": {"_frombuffer"},
+  "numpy._core.numeric": {"_frombuffer"},
+  "numpy.random._pickle": {"__bit_generator_ctor", "__generator_ctor"},
+  "numpy.random._pcg64": {"PCG64"},
+  "numpy.random.bit_generator": {"SeedSequence", "__pyx_unpickle_SeedSequence"},
+  "sim": {"Bitset", "Client", "Command", "EventLog", "Grid", "Player", "Server", "Unit", "new_idd"},
+  "spatial": {"BucketGrid"},
+  "profiler": {"Profiler"},
+  "policy": {"Policy"} | set(policy.STRATEGIES),
+  "net": {"RemoteClient"},
+}
+
+class KeyframeUnpickler(pickle.Unpickler):
+  def find_class(self, module, name):
+    if name not in KEYFRAME_GLOBALS.get(module, ()):
+      raise pickle.UnpicklingError("keyframe refers to {}.{}, which no match is made of".format(module, name))
+    return super().find_class(module, name)
+
+def pack_command(tick, command, pos):
+  # a command record, without its tag
+  units = list(command.units.items())
+  return b"".join([
+      COMMAND.pack(tick, command.id, command.player.index, FORMATIONS.index(command.formation),
+          pos[0], pos[1], len(command.pos), len(units)),
+      array.array("i", [n for waypoint in command.pos for n in waypoint]).tobytes(),
+      array.array("q", [unit.id for unit, _ in units]).tobytes(),
+      array.array("i", [unit_pos[0] for _, unit_pos in units]).tobytes(),
+      array.array("i", [unit_pos[1] for _, unit_pos in units]).tobytes(),
+      ])
+
+def read_array(typecode, data, offset, n):
+  values = array.array(typecode)
+  values.frombytes(data[offset:offset + n * values.itemsize])
+  return values, offset + n * values.itemsize
+
+def unpack_command(data, offset):
+  # (tick, (id, player, formation, origin, waypoints, [(unit id, position)]), offset after it)
+  tick, cid, player, formation, ox, oy, num_waypoints, num_units = COMMAND.unpack_from(data, offset)
+  offset += COMMAND.size
+  waypoints, offset = read_array("i", data, offset, num_waypoints * 2)
+  ids, offset = read_array("q", data, offset, num_units)
+  xs, offset = read_array("i", data, offset, num_units)
+  ys, offset = read_array("i", data, offset, num_units)
+  return tick, (cid, player, FORMATIONS[formation], (ox, oy),
+      list(zip(waypoints[::2], waypoints[1::2])), list(zip(ids, zip(xs, ys)))), offset
+
+def make_command(server, player, formation, waypoints, units, id=None):
+  # units that have died since are only needed for their id and position,
+  # a bare Unit with just the id still matches the live one if it comes back
+  selected = {server.units.get(uid) or sim.new_idd(sim.Unit, uid): pos for uid, pos in units}
+  return sim.Command(server.players[player], selected, waypoints, formation, id=id)
+
+class Recorder:
+  def __init__(self, path, server, clients, keyframe_every=500):
+    self.server = server
+    self.clients = clients
+    self.keyframe_every = keyframe_every
+    self.last_keyframe = None
+    self.file = open(path, "wb")
+    ai = sum(1 << i for i, client in enumerate(clients) if client.ai)
+    self.file.write(HEADER.pack(MAGIC, VERSION, len(server.players), server.map_w, server.map_h,
+        server.seed, server.event_speed, server.move_speed, server.spawn_rate,
+        DEBUG_MOVES if sim.DEBUG["MOVES"] else 0, ai))
+
+  def keyframe(self):
+    # call at the start of every tick; writes one every keyframe_every ticks
+    tick = self.server.tick_no
+    if tick % self.keyframe_every or tick == self.last_keyframe:
+      return
+    self.last_keyframe = tick
+    blob = zlib.compress(pickle.dumps((self.server, self.clients), pickle.HIGHEST_PROTOCOL))
+    self.file.write(b"K" + KEYFRAME.pack(tick, len(blob)))
+    self.file.write(blob)
+    self.file.flush()
+
+  def command(self, command, pos):
+    # call with everything handed to server.broadcast_command
+    self.file.write(b"C" + pack_command(self.server.tick_no, command, pos))
+
+  def close(self):
+    self.file.write(b"E" + END.pack(self.server.tick_no))
+    self.file.close()
+
+class Recording:
+  # a recording file, read in one go. the commands are decoded up front,
+  # keyframes only when something seeks to them
+  def __init__(self, path):
+    with open(path, "rb") as f:
+      self.data = f.read()
+    (magic, version, self.num_players, self.map_w, self.map_h, self.seed, self.event_speed,
+        self.move_speed, self.spawn_rate, self.flags, self.ai) = HEADER.unpack_from(self.data)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("{} is not a version {} recording".format(path, VERSION))
+    self.commands = collections.defaultdict(list)  # tick => list of command tuples
+    self.keyframes = []  # (tick, offset, size) of each keyframe, in tick order
+    self.end = None  # tick the recording stopped on, None if it was cut short
+    offset = HEADER.size
+    while offset < len(self.data):
+      tag = self.data[offset:offset + 1]
+      offset += 1
+      if tag == b"C":
+        tick, command, offset = unpack_command(self.data, offset)
+        self.commands[tick].append(command)
+      elif tag == b"K":
+        tick, size = KEYFRAME.unpack_from(self.data, offset)
+        offset += KEYFRAME.size
+        self.keyframes.append((tick, offset, size))
+        offset += size
+      elif tag == b"E":
+        self.end, = END.unpack_from(self.data, offset)
+        offset += END.size
+      else:
+        raise ValueError("bad record {!r} at {}".format(tag, offset - 1))
+    self.keyframe_ticks = [tick for tick, _, _ in self.keyframes]
+
+  def start(self):
+    # (server, clients) at tick 0, as the recorded match was set up
+    sim.DEBUG["MOVES"] = bool(self.flags & DEBUG_MOVES)
+    server, clients = headless.make_match(self.num_players, self.map_w, self.map_h,
+        ai_players=[i for i in range(self.num_players) if self.ai >> i & 1], seed=self.seed,
+        event_speed=self.event_speed)
+    server.move_speed = self.move_speed
+    server.spawn_rate = self.spawn_rate
+    return server, clients
+
+  def keyframe(self, i):
+    sim.DEBUG["MOVES"] = bool(self.flags & DEBUG_MOVES)
+    _, offset, size = self.keyframes[i]
+    return KeyframeUnpickler(io.BytesIO(zlib.decompress(self.data[offset:offset + size]))).load()
+
+  def step(self, server, clients):
+    # one tick, the same way runner.Runner.step does it
+    for cid, player, formation, origin, waypoints, units in self.commands.get(server.tick_no, ()):
+      server.broadcast_command(make_command(server, player, formation, waypoints, units, cid), origin)
+    server.tick()
+    for client in clients:
+      client.tick()
+
+  def advance(self, server, clients, tick):
+    while server.tick_no < tick:
+      self.step(server, clients)
+
+  def seek(self, tick):
+    # (server, clients) at the start of tick, from the nearest keyframe
+    i = bisect.bisect_right(self.keyframe_ticks, tick) - 1
+    server, clients = self.keyframe(i) if i >= 0 else self.start()
+    self.advance(server, clients, tick)
+    return server, clients
+
+def fingerprint(server):
+  # hash of the server state a desync would show up in. clients are left
+  # out: they only ever see what the server sends them, and the ones in a
+  # keyframe needn't be sim.Clients (see net.RemoteClient)
+  h = hashlib.sha1()
+  h.update(repr((server.tick_no, len(server.log), server.next_unit_id)).encode())
+  h.update(repr(sorted((unit.id, pos, unit.time, unit.active_dst, unit.active_waypoint,
+      unit.active_command and unit.active_command.id) for unit, pos in server.unit_pos.items())).encode())
+  h.update(repr(sorted(server.pending_events())).encode())
+  h.update(repr(sorted(entry[:3] for entry in server.command_queue)).encode())
+  h.update(repr(server.rng.bit_generator.state).encode())
+  h.update(repr(server.random.getstate()).encode())
+  return h.hexdigest()
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("path")
+  parser.add_argument("--seek", type=int, metavar="TICK", help="jump to TICK and print its fingerprint")
+  parser.add_argument("--verify", action="store_true",
+                      help="play the whole recording from tick 0 and check it against every keyframe")
+  args = parser.parse_args()
+  recording = Recording(args.path)
+  print("{} players, {}x{}, seed {}, {} commands, {} keyframes, ends on tick {}".format(
+      recording.num_players, recording.map_w, recording.map_h, recording.seed,
+      sum(len(commands) for commands in recording.commands.values()),
+      len(recording.keyframes), recording.end))
+  if args.seek is not None:
+    start = time.perf_counter()
+    server, clients = recording.seek(args.seek)
+    print("tick {} in {:.3f}s: {}".format(args.seek, time.perf_counter() - start,
+        fingerprint(server)))
+  if args.verify:
+    server, clients = recording.start()
+    for i, tick in enumerate(recording.keyframe_ticks):
+      recording.advance(server, clients, tick)
+      if fingerprint(server) != fingerprint(recording.keyframe(i)[0]):
+        print("desync by tick", tick)
+        sys.exit(1)
+    print("all", len(recording.keyframes), "keyframes match")
+
+if __name__ == "__main__":
+  main()
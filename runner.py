@@ -0,0 +1,83 @@
+import collections
+import threading
+import time
+
+class Snapshot:
+  # what one client could see after a tick. built by the sim thread and
+  # never touched again, so the renderer can read it without locking
+  __slots__ = ("tick", "units", "spawned", "dead", "moves", "commands")
+
+  def __init__(self, tick, units, spawned, dead, moves, commands):
+    self.tick = tick
+    self.units = units  # frozen spatial.BucketGrid of (unit, position)
+    self.spawned = spawned  # frozenset of positions
+    self.dead = dead  # frozenset of positions
+    self.moves = moves  # tuple of (unit, old position, new position)
+    self.commands = commands  # tuple of (command, center, radius)
+
+class Runner:
+  # ticks the server on its own thread at a fixed rate, independent of the
+  # frame rate. commands go in through submit(), snapshots come out of
+  # self.snapshots; both are deques, which are safe to share between one
+  # producer and one consumer thread
+  def __init__(self, server, clients, view, rate, recorder=None):
+    self.server = server
+    self.clients = clients
+    self.view = view  # the client snapshots are taken for
+    self.rate = rate  # ticks per second
+    self.recorder = recorder  # replay.Recorder, if the match is being recorded
+    self.inbox = collections.deque()
+    self.snapshots = collections.deque(maxlen=256)
+    self.snapshot = self.take_snapshot()
+    self.running = False
+    self.thread = None
+
+  def submit(self, command, pos):
+    self.inbox.append((command, pos))
+
+  def take_snapshot(self):
+    return Snapshot(
+        self.server.tick_no,
+        self.view.index.frozen(),
+        frozenset(self.view.spawned),
+        frozenset(self.view.dead),
+        tuple((unit, old, new) for unit, (old, new) in self.view.moves.items()),
+        tuple((command, center, radius)
+          for command, (center, radius) in self.server.command_centers.items()))
+
+  def step(self):
+    if self.recorder:
+      self.recorder.keyframe()
+    while self.inbox:
+      command, pos = self.inbox.popleft()
+      if self.recorder:
+        self.recorder.command(command, pos)
+      self.server.broadcast_command(command, pos)
+    self.server.tick()
+    self.snapshot = self.take_snapshot()
+    self.snapshots.append(self.snapshot)
+    for client in self.clients:
+      client.tick()
+
+  def run(self):
+    next_tick = time.perf_counter()
+    while self.running:
+      now = time.perf_counter()
+      if now < next_tick:
+        time.sleep(next_tick - now)
+        continue
+      self.step()
+      next_tick += 1 / self.rate
+      if now - next_tick > 1:
+        # fell a second behind, don't try to catch up all at once
+        next_tick = now
+
+  def start(self):
+    self.running = True
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.running = False
+    if self.thread:
+      self.thread.join()
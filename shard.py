@@ -0,0 +1,339 @@
+# the move phase split across worker processes, one per strip of map
+# columns. the movers sit in shared memory; each worker resolves the ones in
+# its strip, reading the units just past its edges (the halo) straight out
+# of the same buffers, and works out where their events will arrive. the
+# few results a worker can't vouch for because of something across an edge
+# are redone here, so a match plays out exactly as it would on sim.Server.
+# the event rows those moves send are then sorted by arrival the same way,
+# a run of rows per worker, for the queue to take in whole
+import argparse
+import multiprocessing
+import os
+import random
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import bench
+import headless
+import replay
+import sim
+from moves import KILL, MOVE, STAY, move_squares, resolve_region, walk
+
+# a unit moves at most one square, so two units more than this many columns
+# apart can't touch the same square
+HALO = 2
+
+# kind => its columns, each name => dtype, and whether there's one per
+# observer. "movers" has a row per mover, "rows" one per event row
+COLUMNS = {
+    "movers": {
+        "xs": (np.int64, False),
+        "ys": (np.int64, False),
+        "dxs": (np.int64, False),
+        "dys": (np.int64, False),
+        "players": (np.int64, False),
+        "outcome": (np.int8, False),
+        "new_xs": (np.int64, False),
+        "new_ys": (np.int64, False),
+        "victims": (np.int64, False),
+        "tainted": (np.bool_, False),
+        "arrivals": (np.int64, True),
+        },
+    "rows": {
+        "arrivals": (np.int64, True),
+        "order": (np.int64, True),  # per observer, rows sorted by arrival
+        },
+    # the server's committed map, its ids flattened a column at a time
+    "grid": {
+        "ids": (np.int32, False),
+        },
+    }
+
+class Buffers:
+  # every column of a kind in COLUMNS for up to capacity rows, each in its
+  # own block of shared memory. the creating side passes layout() to the
+  # workers, which attach by name; it has to have its resource tracker
+  # running before they start, so they share it rather than each cleaning
+  # up on exit
+  def __init__(self, kind, capacity, observers, names=None):
+    self.kind = kind
+    self.capacity = capacity
+    self.observers = observers
+    self.blocks = {}
+    self.arrays = {}
+    for column, (dtype, per_observer) in COLUMNS[kind].items():
+      shape = (capacity, observers) if per_observer else (capacity,)
+      size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+      if names is None:
+        block = shared_memory.SharedMemory(create=True, size=size)
+      else:
+        block = shared_memory.SharedMemory(name=names[column])
+      self.blocks[column] = block
+      self.arrays[column] = np.ndarray(shape, dtype, block.buf)
+
+  def layout(self):
+    return (self.kind, self.capacity, self.observers,
+        {column: block.name for column, block in self.blocks.items()})
+
+  def close(self, unlink=False):
+    self.arrays.clear()
+    for block in self.blocks.values():
+      block.close()
+      if unlink:
+        block.unlink()
+
+def work(connection):
+  # a worker: run each (task, layout, args...) it's sent on the buffers
+  # layout describes and send back what it returns, until it's sent None
+  attached = {}  # kind => Buffers
+  while True:
+    job = connection.recv()
+    if job is None:
+      break
+    task, layout, args = job[0], job[1], job[2:]
+    buffers = attached.get(layout[0])
+    if buffers is None or buffers.layout() != layout:
+      if buffers:
+        buffers.close()
+      buffers = attached[layout[0]] = Buffers(*layout)
+    connection.send(task(buffers.arrays, *args))
+  for buffers in attached.values():
+    buffers.close()
+  connection.close()
+
+def scan_strip(a, map_w, map_h, x0, x1):
+  # sim.Server.movers for the map columns x0 to x1
+  ids = a["ids"].reshape(map_w, map_h)[x0:x1]
+  xs, ys = np.nonzero(ids >= 0)
+  return ids[xs, ys].astype(np.int64), xs + x0, ys
+
+def resolve_strip(a, n, x0, x1, map_w, map_h, first_arrival, event_speed, observers):
+  # resolve the movers in columns x0 to x1 and work out where their events
+  # arrive. returns how many there were
+  xs = a["xs"][:n]
+  # movers are in x order, so a strip and its halo are both slices
+  lo, first, last, hi = np.searchsorted(xs, [x0 - HALO, x0, x1, x1 + HALO]).tolist()
+  if first < last:
+    part = slice(lo, hi)
+    outcome, new_xs, new_ys, victims, tainted = resolve_region(
+        xs[part], a["ys"][part], a["dxs"][part], a["dys"][part], a["players"][part],
+        map_w, map_h, xs[part] < x0)
+    own = slice(first - lo, last - lo)
+    a["outcome"][first:last] = outcome[own]
+    a["new_xs"][first:last] = new_xs[own]
+    a["new_ys"][first:last] = new_ys[own]
+    a["victims"][first:last] = np.where(victims[own] >= 0, victims[own] + lo, -1)
+    a["tainted"][first:last] = tainted[own]
+    killing = victims[own] >= 0
+    a["arrivals"][first:last] = first_arrival + (sim.ring_radii(
+        np.where(killing, new_xs[own], xs[first:last]),
+        np.where(killing, new_ys[own], a["ys"][first:last]), observers) - 1) * event_speed
+  return last - first
+
+def group_rows(a, lo, hi):
+  # sim.Server.group_arrivals for event rows lo to hi: each observer's
+  # column of order gets the rows sorted by arrival, and back comes
+  # (observer, arrival ticks, where each starts in that slice of order)
+  groups = []
+  for observer in range(a["arrivals"].shape[1]):
+    column = a["arrivals"][lo:hi, observer]
+    order = np.argsort(column, kind="stable")
+    ticks, starts = np.unique(column[order], return_index=True)
+    a["order"][lo:hi, observer] = order + lo
+    groups.append((observer, ticks.tolist(), starts.tolist()))
+  return groups
+
+class ShardedServer(sim.Server):
+  # a sim.Server with its move phase's array work on shards worker
+  # processes: finding the movers on its map (kept in shared memory),
+  # resolving their moves and working out where their events arrive, a
+  # strip of map columns each, then sorting the event rows by arrival for
+  # the queue, a run of rows each. the rest of the move phase is on the
+  # units themselves and stays here. call close() when done with it
+  min_movers = 2000  # fewer than this and it's quicker to stay in one process
+
+  def __init__(self, shards=None):
+    sim.Server.__init__(self)
+    self.shards = shards or os.cpu_count()
+    self.workers = []  # (process, connection)
+    self.buffers = {}  # kind => Buffers
+
+  def setup(self, num_players, map_w, map_h, clients, seed=None):
+    if self.initialized:
+      return
+    sim.Server.setup(self, num_players, map_w, map_h, clients, seed)
+    resource_tracker.ensure_running()
+    grid = self.shared("grid", map_w * map_h, 1)
+    ids = grid.arrays["ids"].reshape(map_w, map_h)
+    ids[:] = self.map.ids
+    self.map.ids = ids
+    for _ in range(self.shards):
+      connection, child = multiprocessing.Pipe()
+      process = multiprocessing.Process(target=work, args=(child,), daemon=True)
+      process.start()
+      child.close()
+      self.workers.append((process, connection))
+
+  def close(self):
+    for process, connection in self.workers:
+      connection.send(None)
+      process.join()
+      connection.close()
+    self.workers = []
+    if "grid" in self.buffers:
+      # the map stays usable without the shared memory
+      self.map.ids = self.map.ids.copy()
+    for buffers in self.buffers.values():
+      buffers.close(unlink=True)
+    self.buffers = {}
+
+  def shared(self, kind, n, observers):
+    # Buffers of kind with room for n, grown to at least double when not
+    buffers = self.buffers.get(kind)
+    if buffers is None or buffers.capacity < n or buffers.observers != observers:
+      capacity = n
+      if buffers:
+        capacity = max(n, 2 * buffers.capacity)
+        buffers.close(unlink=True)
+      buffers = self.buffers[kind] = Buffers(kind, capacity, observers)
+    return buffers
+
+  def run_jobs(self, jobs):
+    # one job per worker, all at once; their results in the same order
+    for (_, connection), job in zip(self.workers, jobs):
+      connection.send(job)
+    return [connection.recv() for (_, connection), _ in zip(self.workers, jobs)]
+
+  def movers(self):
+    if len(self.unit_pos) < self.min_movers or not self.workers:
+      return sim.Server.movers(self)
+    layout = self.buffers["grid"].layout()
+    cuts = [self.map_w * k // len(self.workers) for k in range(len(self.workers) + 1)]
+    strips = self.run_jobs([(scan_strip, layout, self.map_w, self.map_h, x0, x1)
+        for x0, x1 in zip(cuts, cuts[1:])])
+    return tuple(np.concatenate(column) for column in zip(*strips))
+
+  def resolve(self, xs, ys, dxs, dys, players):
+    n = len(xs)
+    if n < self.min_movers or not self.workers:
+      return sim.Server.resolve(self, xs, ys, dxs, dys, players)
+    buffers = self.shared("movers", n, len(self.observers))
+    a = buffers.arrays
+    for column, values in (("xs", xs), ("ys", ys), ("dxs", dxs), ("dys", dys), ("players", players)):
+      a[column][:n] = values
+    # strips with about as many movers each
+    cuts = [0] + [int(xs[n * k // len(self.workers)]) for k in range(1, len(self.workers))] + [self.map_w]
+    layout = buffers.layout()
+    first_arrival = self.first_expansion(self.tick_no)
+    self.run_jobs([(resolve_strip, layout, n, x0, x1, self.map_w, self.map_h,
+        first_arrival, self.event_speed, self.observers) for x0, x1 in zip(cuts, cuts[1:])])
+    outcome = a["outcome"][:n].copy()
+    new_xs = a["new_xs"][:n].copy()
+    new_ys = a["new_ys"][:n].copy()
+    victims = a["victims"][:n].copy()
+    arrivals = a["arrivals"][:n].copy()
+    tainted = np.flatnonzero(a["tainted"][:n])
+    self.profiler.count("movers redone", len(tainted))
+    if len(tainted):
+      self.redo(tainted, xs, ys, dxs, dys, players, outcome, new_xs, new_ys, victims)
+      killing = victims[tainted] >= 0
+      arrivals[tainted] = self.arrivals(np.where(killing, new_xs[tainted], xs[tainted]),
+          np.where(killing, new_ys[tainted], ys[tainted]))
+    acting = (outcome == MOVE) | (outcome == KILL)
+    return outcome, new_xs, new_ys, victims, arrivals[acting]
+
+  def group_arrivals(self, arrivals):
+    n, observers = arrivals.shape
+    if n < self.min_movers or not self.workers:
+      yield from sim.Server.group_arrivals(self, arrivals)
+      return
+    buffers = self.shared("rows", n, observers)
+    a = buffers.arrays
+    a["arrivals"][:n] = arrivals
+    cuts = [n * k // len(self.workers) for k in range(len(self.workers) + 1)]
+    pieces = self.run_jobs([(group_rows, buffers.layout(), lo, hi) for lo, hi in zip(cuts, cuts[1:])])
+    for lo, hi, groups in zip(cuts, cuts[1:], pieces):
+      for observer, ticks, starts in groups:
+        for tick, rows in zip(ticks, np.split(a["order"][lo:hi, observer], starts[1:])):
+          yield observer, tick, rows
+
+  def redo(self, tainted, xs, ys, dxs, dys, players, outcome, new_xs, new_ys, victims):
+    # walk the tainted movers again, in order, against everyone else's
+    # results. nothing that wasn't tainted ever touched a square a tainted
+    # mover did before it, so the ones already done that matter here are
+    # exactly those standing on one of the tainted movers' squares
+    cell, target, rerouted = move_squares(xs, ys, dxs, dys, self.map_w, self.map_h)
+    touched = np.unique(np.concatenate((cell[tainted], target[tainted], rerouted[tainted])))
+    sure = np.ones(len(xs), dtype=bool)
+    sure[tainted] = False
+    killed = victims[sure & (outcome == KILL)]
+    standing = sure & ((outcome == MOVE) | (outcome == STAY))
+    standing[killed] = False
+    final = new_xs * self.map_h + new_ys
+    obstacles = np.flatnonzero(standing & np.isin(final, touched))
+    order = tainted.tolist()
+    others = obstacles.tolist()
+    alive = set(order).difference(killed.tolist())
+    # a tainted mover someone sure already killed is off the map before its turn
+    occupied = dict(zip(final[obstacles].tolist(), others))
+    occupied.update((square, i) for square, i in zip(cell[tainted].tolist(), order) if i in alive)
+    everyone = order + others
+    players = dict(zip(everyone, players[everyone].tolist()))
+    outcome[tainted] = STAY
+    new_xs[tainted] = xs[tainted]
+    new_ys[tainted] = ys[tainted]
+    victims[tainted] = -1
+    walk(order, occupied, alive, dict(zip(order, cell[tainted].tolist())),
+        dict(zip(order, target[tainted].tolist())), dict(zip(order, rerouted[tainted].tolist())),
+        players, outcome, new_xs, new_ys, victims, self.map_h)
+
+def make_match(shards, num_players, map_w, map_h, units, seed):
+  # units a side scattered over the two halves of the map, charging
+  random.seed(seed)
+  server = ShardedServer(shards) if shards else sim.Server()
+  server, clients = headless.make_match(num_players, map_w, map_h,
+      ai_players=range(num_players), seed=seed, server=server)
+  for client in clients:
+    client.policy = bench.CHARGE
+  bench.fill(server, server.players[0], units, 0, map_h // 2, map_w, map_h)
+  bench.fill(server, server.players[1], units, 0, 0, map_w, map_h // 2)
+  return server, clients
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--shards", type=int, default=os.cpu_count())
+  parser.add_argument("--width", type=int, default=2000)
+  parser.add_argument("--height", type=int, default=2000)
+  parser.add_argument("--units", type=int, default=20000, help="per side")
+  parser.add_argument("--ticks", type=int, default=100)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--check", action="store_true",
+                      help="also play it on one process and compare every tick")
+  args = parser.parse_args()
+  sim.DEBUG["MOVES"] = False
+  server, clients = make_match(args.shards, 2, args.width, args.height, args.units, args.seed)
+  if args.check:
+    single, single_clients = make_match(0, 2, args.width, args.height, args.units, args.seed)
+  elapsed = 0
+  single_elapsed = 0
+  try:
+    for _ in range(args.ticks):
+      elapsed += headless.run(server, clients, 1)
+      if args.check:
+        single_elapsed += headless.run(single, single_clients, 1)
+        if replay.fingerprint(server) != replay.fingerprint(single):
+          print("differs from one process on tick", single.tick_no)
+          raise SystemExit(1)
+  finally:
+    if args.shards:
+      server.close()
+  print("{} ticks on {} shards in {:.2f}s ({:.1f} ticks/s), {} units left, {} movers redone".format(
+      args.ticks, args.shards, elapsed, args.ticks / elapsed, len(server.unit_pos),
+      server.profiler.totals["movers redone"]))
+  if args.check:
+    print("one process: {:.2f}s ({:.1f} ticks/s), identical every tick".format(
+        single_elapsed, args.ticks / single_elapsed))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,786 @@
+import array
+import functools
+import heapq
+import math
+import random
+import collections
+
+import numpy as np
+
+import logger
+import policy
+from profiler import Profiler
+from spatial import BucketGrid
+from moves import resolve_moves, MOVE, KILL
+
+DEBUG = {
+        "MOVES": True,
+        "PROFILE": False,  # dump tick timings to profile.json on exit
+        "RECORD": False,  # record the match to replay.bin, see replay.py
+        "LOG": False,  # also write debug lines to debug.log
+        }
+
+event_speed = 5
+move_speed = 10
+spawn_rate = 500  # ticks between spawns, 50 when DEBUG["MOVES"] is on
+
+def ring_radius(center, pos):
+  # the ring an event started at center is on when it reaches pos
+  distance = math.sqrt((pos[0] - center[0]) ** 2 + (pos[1] - center[1]) ** 2)
+  return max(1, int(distance + 0.5))
+
+def ring_radii(xs, ys, points):
+  # ring_radius from each of xs, ys to each of points, as an array of shape
+  # (len(xs), len(points)). same sums, so the same answers
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+  dx = xs[:, None] - points[:, 0]
+  dy = ys[:, None] - points[:, 1]
+  return np.maximum(1, np.floor(np.sqrt(dx * dx + dy * dy) + 0.5)).astype(np.int64)
+
+# offset tables don't depend on the center, so this only ever holds one
+# entry per radius; it's bounded anyway so a huge map can't pin them all
+@functools.lru_cache(maxsize=256)
+def ring_offsets(radius):
+  # every offset with ring_radius == radius, so rings 1, 2, 3... cover the
+  # plane exactly once; ring 1 includes the center
+  r = radius + 1
+  dx, dy = np.mgrid[-r:r + 1, -r:r + 1]
+  rings = np.maximum(np.floor(np.sqrt(dx ** 2 + dy ** 2) + 0.5), 1)
+  mask = rings == radius
+  offsets = np.stack((dx[mask], dy[mask]), axis=1).astype(np.int32)
+  offsets.flags.writeable = False
+  return offsets
+
+def circle(center, radius, map_w=None, map_h=None):
+  # returns (xs, ys) arrays, clipped to the map if its size is given
+  offsets = ring_offsets(radius)
+  xs = offsets[:, 0] + center[0]
+  ys = offsets[:, 1] + center[1]
+  if map_w is not None:
+    inside = (xs >= 0) & (xs < map_w) & (ys >= 0) & (ys < map_h)
+    xs = xs[inside]
+    ys = ys[inside]
+  return xs, ys
+
+class Player:
+  __slots__ = ("index", "spawnpoint")
+
+  def __init__(self, index, spawnpoint):
+    self.index = index
+    self.spawnpoint = spawnpoint
+
+sid = 0
+def new_idd(cls, id):
+  idd = cls.__new__(cls)
+  idd.id = id
+  return idd
+
+class Idd:
+  __slots__ = ("id",)
+
+  def __init__(self, id=None):
+    global sid
+    if id is None:
+      id = sid
+      sid += 1
+    self.id = id
+
+  def __reduce_ex__(self, protocol):
+    # unpickle with the id already set: idds are dict keys all over, and
+    # pickle rebuilds those dicts before it gets round to the slots
+    return (new_idd, (type(self), self.id)) + object.__reduce_ex__(self, protocol)[2:]
+
+  def __hash__(self):
+    return hash(self.id)
+
+  def __eq__(self, other):
+    # units and commands are numbered by different counters, so ids alone
+    # can clash across types
+    return type(self) is type(other) and self.id == other.id
+
+  def __lt__(self, other):
+    return self.id < other.id
+
+class Unit(Idd):
+  __slots__ = ("player", "personality", "skin", "active_dst", "active_waypoint",
+               "active_command", "last_command_seq", "time")
+
+  # the server hands out id and rng (see Server.new_unit) so a seeded
+  # match comes out the same every time
+  def __init__(self, player, id=None, rng=random):
+    Idd.__init__(self, id)
+    self.player = player
+    self.personality = rng.randint(1, 255)
+    self.skin = (rng.randint(1, 255),
+        rng.randint(1, 255),
+        rng.randint(1, 255))
+    self.active_dst = None
+    self.active_waypoint = None
+    self.active_command = None
+    self.last_command_seq = -1
+    self.time = 0
+
+  def __str__(self):
+    return "[unit id={} player={}]".format(self.id, self.player.index)
+
+  def __repr__(self):
+    return str(self)
+
+  def command(self, command):
+    if command.player != self.player or self not in command.units:
+      # ignore commands not meant for me
+      return
+    if command.id <= self.last_command_seq:
+      # ignore stale/duplicate commands
+      return
+    if self.active_command is None or self.active_command != command:
+      self.active_command = command
+      self.active_waypoint = 0
+    self.active_dst = command.destination(self, self.active_waypoint)
+    self.last_command_seq = command.id
+
+  # head for the active destination; units without one are moved by
+  # their client's policy instead
+  def get_move(self, pos):
+    dx, dy = 0, 0
+    if self.active_dst[0] < pos[0]:
+      dx = -1
+    elif self.active_dst[0] > pos[0]:
+      dx = 1
+    if self.active_dst[1] < pos[1]:
+      dy = -1
+    elif self.active_dst[1] > pos[1]:
+      dy = 1
+    if dx == 0 and dy == 0:
+      if self.active_waypoint is not None:
+        self.active_waypoint += 1
+        if self.active_waypoint >= len(self.active_command.pos):
+          self.active_waypoint = None
+          self.active_command = None
+        else:
+          self.active_dst = self.active_command.destination(self, self.active_waypoint)
+    return (dx, dy)
+
+# formation shapes: n => list of n (col, row) offsets from the waypoint
+def grid_formation(n):
+  num_cols = int(math.ceil(1.25 * math.sqrt(n)))
+  num_rows = n // num_cols + 1
+  return [(col, row) for col in range(num_cols) for row in range(num_rows)][:n]
+
+def line_formation(n):
+  return [(col, 0) for col in range(n)]
+
+def wedge_formation(n):
+  # point on the waypoint, each rank behind it one wider on both sides
+  slots = []
+  rank = 0
+  while len(slots) < n:
+    slots.extend((col, rank) for col in range(-rank, rank + 1))
+    rank += 1
+  return slots[:n]
+
+FORMATIONS = {
+    "grid": grid_formation,
+    "line": line_formation,
+    "wedge": wedge_formation,
+    }
+
+class Command(Idd):
+  # units is dict of unit -> selected positions
+  __slots__ = ("player", "units", "pos", "formation", "slots", "destinations")
+
+  def __init__(self, player, units, pos, formation="grid", id=None):
+    Idd.__init__(self, id)
+    self.player = player
+    self.units = units
+    self.pos = pos
+    self.formation = formation
+    self.slots = None  # unit => (col, row), worked out on first use
+    self.destinations = {}  # waypoint => {unit => position}
+
+  def slot(self, unit):
+    if self.slots is None:
+      # sort by x, break ties by y
+      sunits = sorted(self.units, key=lambda unit: self.units[unit])
+      logger.once(self.id, logger.DEBUG, "commands", "formation", self.formation, "of", len(sunits))
+      self.slots = dict(zip(sunits, FORMATIONS[self.formation](len(sunits))))
+    return self.slots[unit]
+
+  def destination(self, unit, waypoint):
+    plan = self.destinations.get(waypoint)
+    if plan is None:
+      plan = self.destinations[waypoint] = {}
+    dst = plan.get(unit)
+    if dst is None:
+      pos = self.pos[waypoint]
+      spot = self.slot(unit)
+      dst = plan[unit] = (pos[0] + spot[0], pos[1] + spot[1])
+    return dst
+
+class Event:
+  # one row of the server's EventLog, as handed to a client; id is the row
+  # if old_pos is None, the unit is spawning
+  # if new_pos is None, the unit is dying
+  __slots__ = ("id", "tick", "unit", "old_pos", "new_pos")
+
+  def __init__(self, index, tick, unit, old_pos, new_pos):
+    self.id = index
+    self.tick = tick
+    self.unit = unit
+    self.old_pos = old_pos
+    self.new_pos = new_pos
+
+class EventLog:
+  # every broadcast event as parallel columns, referred to by row index.
+  # positions holds old x, old y, new x, new y for each row, with (-1, -1)
+  # for a missing position. rows before base have been trimmed once
+  # nothing was waiting on them any more
+  def __init__(self):
+    self.base = 0
+    self.ticks = array.array("q")
+    self.unit_ids = array.array("q")
+    self.positions = array.array("i")
+    self.units = []  # the unit for each row
+
+  def __len__(self):
+    return self.base + len(self.ticks)
+
+  def append(self, tick, unit, old_pos, new_pos):
+    self.ticks.append(tick)
+    self.unit_ids.append(unit.id)
+    self.positions.extend((old_pos or (-1, -1)) + (new_pos or (-1, -1)))
+    self.units.append(unit)
+    return len(self) - 1
+
+  def extend(self, tick, units, positions):
+    # a row per unit, all sent on tick, with positions as an array of rows
+    # like the log's own. returns the index of the first
+    first = len(self)
+    self.ticks.frombytes(np.full(len(units), tick, dtype=np.int64).tobytes())
+    self.unit_ids.extend([unit.id for unit in units])
+    self.positions.frombytes(np.ascontiguousarray(positions, dtype=np.int32).tobytes())
+    self.units.extend(units)
+    return first
+
+  def event(self, index):
+    i = index - self.base
+    old_x, old_y, new_x, new_y = self.positions[4 * i:4 * i + 4]
+    old_pos = (old_x, old_y) if old_x >= 0 else None
+    new_pos = (new_x, new_y) if new_x >= 0 else None
+    return Event(index, self.ticks[i], self.units[i], old_pos, new_pos)
+
+  def batch(self, indices):
+    # the rows at indices as an EventBatch, in index order, each row once
+    rows = np.unique(np.asarray(indices, dtype=np.int64)) - self.base
+    return EventBatch(rows + self.base, np.frombuffer(self.ticks, np.int64)[rows],
+        [self.units[i] for i in rows.tolist()],
+        np.frombuffer(self.positions, np.int32).reshape(-1, 4)[rows])
+
+  def trim(self, first):
+    # forget every row before index first
+    n = first - self.base
+    if n <= 0:
+      return
+    for column in (self.ticks, self.unit_ids, self.units):
+      del column[:n]
+    del self.positions[:4 * n]
+    self.base = first
+
+class EventBatch:
+  # events as columns, the way a client takes them in a tick at a time: ids,
+  # ticks, the units, and a row of old x, old y, new x, new y per event with
+  # -1s for a missing position, like the EventLog. each id is in it once and
+  # they go up, so the ticks never go down either
+  __slots__ = ("ids", "ticks", "units", "positions")
+
+  def __init__(self, ids, ticks, units, positions):
+    self.ids = ids
+    self.ticks = ticks
+    self.units = units
+    self.positions = positions
+
+  def __len__(self):
+    return len(self.ids)
+
+def event_batch(events):
+  # an EventBatch of Event objects
+  events = sorted({event.id: event for event in events}.values(), key=lambda event: event.id)
+  return EventBatch(np.array([event.id for event in events], dtype=np.int64),
+      np.array([event.tick for event in events], dtype=np.int64),
+      [event.unit for event in events],
+      np.array([(event.old_pos or (-1, -1)) + (event.new_pos or (-1, -1)) for event in events],
+          dtype=np.int32).reshape(-1, 4))
+
+class Grid:
+  # which unit is on each square, stored as unit ids (-1 is empty) with the
+  # unit objects in a side table shared by both of the server's buffers.
+  # writes are journaled if given a journal, so the server can commit just
+  # the squares that changed
+  def __init__(self, w, h, units, journal=None):
+    self.ids = np.full((w, h), -1, dtype=np.int32)
+    self.units = units
+    self.journal = journal
+
+  def __getitem__(self, pos):
+    uid = self.ids.item(pos)
+    if uid < 0:
+      return None
+    return self.units[uid]
+
+  def __setitem__(self, pos, unit):
+    if unit is None:
+      self.ids[pos] = -1
+    else:
+      self.units[unit.id] = unit
+      self.ids[pos] = unit.id
+    if self.journal is not None:
+      self.journal.append(((pos[0],), (pos[1],)))
+
+  def put(self, xs, ys, ids):
+    # ids (-1 for empty) onto the squares at xs, ys, in one go. the units
+    # have to be in the side table already
+    self.ids[xs, ys] = ids
+    if self.journal is not None:
+      self.journal.append((xs, ys))
+
+class Bitset:
+  # set of non-negative ints (unit ids), one bit each
+  def __init__(self):
+    self.bits = bytearray()
+    self.count = 0
+
+  def add(self, i):
+    byte = i >> 3
+    if byte >= len(self.bits):
+      # grow by at least double so adds stay amortized O(1)
+      self.bits.extend(bytes(max(byte + 1, 2 * len(self.bits)) - len(self.bits)))
+    mask = 1 << (i & 7)
+    if not self.bits[byte] & mask:
+      self.bits[byte] |= mask
+      self.count += 1
+
+  def __contains__(self, i):
+    byte = i >> 3
+    return byte < len(self.bits) and bool(self.bits[byte] & (1 << (i & 7)))
+
+  def __len__(self):
+    return self.count
+
+class Client:
+  def __init__(self):
+    self.initialized = False
+
+  def setup(self, player, map_w, map_h, ai=False, event_speed=event_speed):
+    # event_speed: the server's, which the horizon depends on
+    if self.initialized:
+      return
+    self.ai = ai
+    self.policy = policy.AI if ai else policy.IDLE
+    self.player = player
+    self.player_index = player.index
+    self.map_w = map_w
+    self.map_h = map_h
+    self.dead = set()
+    self.spawned = set()
+    self.moves = {}  # unit => (old position, new position), this tick
+    self.perma_dead = Bitset()  # unit IDs
+    self.units = {}  # unit => position
+    self.index = BucketGrid()  # (unit, position), for range queries
+    # an event turns up at most horizon ticks after it was sent, so once
+    # newer events have been seen the older ids are dropped and anything
+    # that old is treated as already seen
+    self.horizon = ring_radius((0, 0), (map_w, map_h)) * event_speed
+    self.newest_tick = 0
+    self.seen = np.zeros(1024, dtype=bool)  # event id - seen_base => seen
+    self.seen_base = 0
+    # (tick, last id) of each batch taken in, to know when ids fall out of
+    # the horizon. event ids go up with the tick they were sent on
+    self.seen_marks = collections.deque()
+    self.initialized = True
+
+  def handle_event(self, event):
+    self.apply_batch(event_batch([event]))
+
+  def apply_batch(self, batch):
+    # take in an EventBatch. what's been seen before is dropped up front, the
+    # rest updates the view in one pass, so a tick costs what's new in it.
+    # ids below seen_base were all sent before the horizon, so the tick
+    # check drops those before they're looked up
+    ids = batch.ids - self.seen_base
+    rows = np.flatnonzero(batch.ticks >= self.newest_tick - self.horizon)
+    if not len(rows):
+      return
+    if ids[-1] >= len(self.seen):
+      self.seen = np.concatenate((self.seen,
+          np.zeros(max(ids[-1] + 1, 2 * len(self.seen)) - len(self.seen), dtype=bool)))
+    rows = rows[~self.seen[ids[rows]]]
+    if not len(rows):
+      return
+    self.seen[ids[rows]] = True
+    last = rows[-1]
+    self.newest_tick = max(self.newest_tick, int(batch.ticks[last]))
+    self.forget_seen(int(batch.ticks[last]), int(batch.ids[last]))
+    units = batch.units
+    for i, (old_x, old_y, new_x, new_y) in zip(rows.tolist(), batch.positions[rows].tolist()):
+      unit = units[i]
+      if unit in self.units:
+        pos = self.units.pop(unit)
+        self.index.remove(unit, pos)
+      if new_x >= 0 and unit.id not in self.perma_dead:
+        new_pos = (new_x, new_y)
+        if old_x < 0:
+          # something spawned
+          self.spawned.add(new_pos)
+        self.units[unit] = new_pos
+        self.index.add(unit, new_pos)
+        if old_x >= 0:
+          self.moves[unit] = ((old_x, old_y), new_pos)
+      if old_x >= 0 and new_x < 0:
+        # something died
+        self.dead.add((old_x, old_y))
+        self.perma_dead.add(unit.id)
+
+  def forget_seen(self, tick, last_id):
+    # every id up to one sent before the horizon is too old to need a bit,
+    # so slide the window past them once that's half of it
+    self.seen_marks.append((tick, last_id))
+    first = self.seen_base
+    while self.seen_marks[0][0] < self.newest_tick - self.horizon:
+      first = self.seen_marks.popleft()[1] + 1
+    if first - self.seen_base > len(self.seen) // 2:
+      self.seen = self.seen[first - self.seen_base:].copy()
+      self.seen_base = first
+
+  def tick(self):
+    self.dead.clear()
+    self.spawned.clear()
+    self.moves.clear()
+
+class Server:
+  def __init__(self):
+    self.initialized = False
+
+  def setup(self, num_players, map_w, map_h, clients, seed=None):
+    if self.initialized:
+      return
+    self.clients = clients
+    if seed is None:
+      seed = random.randrange(2 ** 63)
+    self.seed = seed
+    self.rng = np.random.default_rng(seed)  # for policies
+    self.random = random.Random(seed)  # for new units
+    self.next_unit_id = 0
+    self.profiler = Profiler()
+    self.event_speed = event_speed
+    self.move_speed = move_speed
+    self.spawn_rate = spawn_rate
+    self.tick_no = 0
+    self.map_w = map_w
+    self.map_h = map_h
+    self.units = {}  # unit id => unit, for anything on map or new_map
+    self.journal = []  # (xs, ys) of squares written in new_map since the last commit
+    self.killed = []  # units to drop from self.units on the next commit
+    self.kills = collections.Counter()  # player index => enemy units it took out
+    self.losses = collections.Counter()  # player index => units it lost
+    self.map = Grid(map_w, map_h, self.units)
+    self.new_map = Grid(map_w, map_h, self.units, self.journal)
+    self.observers = []  # observer index => point
+    self.log = EventLog()
+    # arrival tick => list of (observer, log indices) due then, with a heap
+    # of its keys. events are queued a tick's worth at a time, and they only
+    # ever arrive on expansion ticks, so there are few keys and big buckets
+    self.event_queue = {}
+    self.arrival_ticks = []
+    self.events_pending = 0
+    self.command_centers = {}  # command => (center point, radius)
+    # heap of (arrival tick, command id, unit id, command, unit, center, broadcast tick)
+    self.command_queue = []
+    self.unit_pos = {}  # unit => position, for every live unit
+    self.players = []
+    center = (map_w / 2, map_h / 2)
+    radius = min(map_w, map_h) / 2 * (7 / 8)
+    for player in range(num_players):
+      angle = math.radians(90 + player * 360 / num_players)
+      spawnpoint = (int(center[0] + radius * math.cos(angle)),
+          int(center[1] + radius * math.sin(angle)))
+      self.players.append(Player(player, spawnpoint))
+      # player i's client watches from observer i
+      self.add_observer(spawnpoint)
+    self.initialized = True
+
+  def add_observer(self, pos):
+    self.observers.append(pos)
+    return len(self.observers) - 1
+
+  def first_expansion(self, tick):
+    # rings grow one square per expansion, starting at radius 1 on the
+    # first expansion tick at or after the broadcast
+    return -(-tick // self.event_speed) * self.event_speed
+
+  def arrival_tick(self, tick, center, pos):
+    return self.first_expansion(tick) + (ring_radius(center, pos) - 1) * self.event_speed
+
+  def radius_at(self, tick, now):
+    # radius on tick now of a ring broadcast on tick
+    first = self.first_expansion(tick)
+    if now < first:
+      return 0
+    return (now - first) // self.event_speed + 1
+
+  def arrivals(self, xs, ys):
+    # arrival tick at each observer of events sent this tick from xs, ys,
+    # one row per position
+    return (self.first_expansion(self.tick_no) +
+        (ring_radii(xs, ys, self.observers) - 1) * self.event_speed)
+
+  def broadcast_event(self, unit, old_pos, new_pos, pos):
+    index = self.log.append(self.tick_no, unit, old_pos, new_pos)
+    for observer, point in enumerate(self.observers):
+      self.queue(self.arrival_tick(self.tick_no, pos, point), observer, [index])
+
+  def broadcast_events(self, units, positions, arrivals):
+    # log rows for units with positions (see EventLog.extend), sent this
+    # tick, arriving at each observer on the ticks in the same row of
+    # arrivals
+    first = self.log.extend(self.tick_no, units, positions)
+    for observer, tick, rows in self.group_arrivals(arrivals):
+      self.queue(tick, observer, rows + first)
+
+  def group_arrivals(self, arrivals):
+    # (observer, arrival tick, rows arriving then, going up) for every
+    # observer and tick in arrivals
+    for observer in range(arrivals.shape[1]):
+      column = arrivals[:, observer]
+      order = np.argsort(column, kind="stable")
+      ticks, starts = np.unique(column[order], return_index=True)
+      for tick, rows in zip(ticks.tolist(), np.split(order, starts[1:])):
+        yield observer, tick, rows
+
+  def queue(self, tick, observer, indices):
+    bucket = self.event_queue.get(tick)
+    if bucket is None:
+      bucket = self.event_queue[tick] = []
+      heapq.heappush(self.arrival_ticks, tick)
+    bucket.append((observer, indices))
+    self.events_pending += len(indices)
+
+  def pending_events(self):
+    # everything still queued, as (arrival tick, log index, observer)
+    return [(tick, index, observer) for tick, bucket in self.event_queue.items()
+        for observer, indices in bucket for index in np.asarray(indices).tolist()]
+
+  def broadcast_command(self, command, pos):
+    self.command_centers[command] = (pos, 0)
+    for unit in command.units:
+      self.schedule_command(command, unit, pos, self.tick_no)
+
+  def schedule_command(self, command, unit, center, tick):
+    pos = self.unit_pos.get(unit)
+    if pos is None:
+      return  # dead
+    arrival = self.arrival_tick(tick, center, pos)
+    heapq.heappush(self.command_queue,
+        (arrival, command.id, unit.id, command, unit, center, tick))
+
+  def deliver_events(self):
+    # everything due this tick, as one batch per observer
+    due = collections.defaultdict(list)  # observer => lists of log indices
+    delivered = 0
+    while self.arrival_ticks and self.arrival_ticks[0] <= self.tick_no:
+      for observer, indices in self.event_queue.pop(heapq.heappop(self.arrival_ticks)):
+        delivered += len(indices)
+        due[observer].append(indices)
+    self.events_pending -= delivered
+    for observer, indices in due.items():
+      batch = self.log.batch(np.concatenate(indices))
+      for client in self.clients:
+        if client.player_index == observer:
+          client.apply_batch(batch)
+    self.profiler.count("events delivered", delivered)
+    self.profiler.count("events pending", self.events_pending)
+    # drop log rows nobody is waiting on, once there's a good few of them
+    kept = len(self.log.ticks)
+    if kept > 4096 and kept > 2 * self.events_pending:
+      # each list of indices goes up, so its first is its oldest
+      first = min((int(indices[0]) for bucket in self.event_queue.values() for _, indices in bucket),
+          default=len(self.log))
+      self.log.trim(first)
+
+  def expand_commands(self):
+    # the rings themselves are only kept around for drawing
+    max_radius = ring_radius((0, 0), (self.map_w, self.map_h))
+    for command, (center, radius) in list(self.command_centers.items()):
+      if radius + 1 > max_radius:
+        del self.command_centers[command]
+      else:
+        self.command_centers[command] = (center, radius + 1)
+    delivered = 0
+    while self.command_queue and self.command_queue[0][0] <= self.tick_no:
+      _, _, _, command, unit, center, tick = heapq.heappop(self.command_queue)
+      pos = self.unit_pos.get(unit)
+      if pos is None:
+        continue
+      if self.arrival_tick(tick, center, pos) > self.tick_no:
+        # it walked away from the ring, catch it later
+        self.schedule_command(command, unit, center, tick)
+        continue
+      unit.command(command)
+      delivered += 1
+    self.profiler.count("commands delivered", delivered)
+
+  def new_unit(self, player):
+    unit = Unit(player, self.next_unit_id, self.random)
+    self.next_unit_id += 1
+    return unit
+
+  def spawn(self, unit, pos):
+    if not self.map[pos]:
+#      logger.debug("sim", "spawning", unit, "at", pos)
+      self.map[pos] = unit
+      self.new_map[pos] = unit
+      self.unit_pos[unit] = pos
+      self.broadcast_event(unit, None, pos, pos)
+
+  def execute_moves(self):
+    if self.journal:
+      xs = np.concatenate([xs for xs, _ in self.journal]).astype(np.intp)
+      ys = np.concatenate([ys for _, ys in self.journal]).astype(np.intp)
+      self.map.ids[xs, ys] = self.new_map.ids[xs, ys]
+      self.journal.clear()
+    for unit in self.killed:
+      self.units.pop(unit.id, None)
+    self.killed.clear()
+
+  def resolve(self, xs, ys, dxs, dys, players):
+    # moves.resolve_moves, plus the arrival ticks of the events each mover
+    # that moves or kills sends: from where it was for a move, where it
+    # ended for a kill. one row per such mover, in order
+    outcome, new_xs, new_ys, victims = resolve_moves(
+        xs, ys, dxs, dys, players, self.map_w, self.map_h)
+    acting = (outcome == MOVE) | (outcome == KILL)
+    killing = victims[acting] >= 0
+    arrivals = self.arrivals(np.where(killing, new_xs[acting], xs[acting]),
+        np.where(killing, new_ys[acting], ys[acting]))
+    return outcome, new_xs, new_ys, victims, arrivals
+
+  def movers(self):
+    # ids, xs and ys of every unit on the map, in the x-then-y order a scan
+    # over the whole map visits them in
+    xs, ys = np.nonzero(self.map.ids >= 0)
+    return self.map.ids[xs, ys].astype(np.int64), xs, ys
+
+  def choose_moves(self, units, ids, xs, ys, players, times):
+    # dxs, dys for every mover: its orders if it has any and its player
+    # isn't an AI, its client's policy otherwise
+    dxs = np.zeros(len(units), dtype=np.int64)
+    dys = np.zeros(len(units), dtype=np.int64)
+    for client in self.clients:
+      mine = np.flatnonzero(players == client.player_index)
+      if not client.ai:
+        # units under orders walk on their own
+        ordered = [i for i in mine.tolist() if units[i].active_dst]
+        for i in ordered:
+          dxs[i], dys[i] = units[i].get_move((int(xs[i]), int(ys[i])))
+        if ordered:
+          mine = np.setdiff1d(mine, ordered)
+      strats = client.policy.strategy_ids(ids[mine])
+      dxs[mine], dys[mine] = client.policy.moves(
+          client, xs[mine], ys[mine], times[mine], strats, self.rng)
+    return dxs, dys
+
+  def move_phase(self):
+    ids, xs, ys = self.movers()
+    if not len(ids):
+      return
+    units = [self.units[uid] for uid in ids.tolist()]
+    for unit in units:
+      unit.time += 1
+    players = np.array([unit.player.index for unit in units])
+    times = np.array([unit.time for unit in units])
+    dxs, dys = self.choose_moves(units, ids, xs, ys, players, times)
+    outcome, new_xs, new_ys, victims, arrivals = self.resolve(xs, ys, dxs, dys, players)
+    self.apply_moves(units, ids, xs, ys, outcome, new_xs, new_ys, victims, arrivals)
+
+  def apply_moves(self, units, ids, xs, ys, outcome, new_xs, new_ys, victims, arrivals):
+    # what resolve() worked out, all at once, coming out as if each mover
+    # had been moved in turn. a move sends one event from where the unit
+    # was, a kill three (the move, then both deaths) from where it happened
+    moved = outcome == MOVE
+    self.profiler.count("units moved", int(moved.sum()))
+    acting = np.flatnonzero(moved | (outcome == KILL))
+    if not len(acting):
+      return
+    victims = victims[acting]
+    killing = victims >= 0
+    counts = np.where(killing, 3, 1)
+    starts = np.cumsum(counts) - counts
+    new = np.stack((new_xs[acting], new_ys[acting]), axis=1)
+    positions = np.full((int(counts.sum()), 4), -1, dtype=np.int32)
+    positions[starts, 0] = xs[acting]
+    positions[starts, 1] = ys[acting]
+    positions[starts, 2:] = new
+    positions[starts[killing] + 1, :2] = new[killing]
+    positions[starts[killing] + 2, :2] = new[killing]
+    event_units = []
+    for i, victim in zip(acting.tolist(), victims.tolist()):
+      if victim < 0:
+        event_units.append(units[i])
+      else:
+        event_units += (units[i], units[i], units[victim])
+    self.broadcast_events(event_units, positions, np.repeat(arrivals, counts, axis=0))
+
+    # a square someone leaves is only ever filled again later on, so
+    # emptying every square left or fought over, then filling in where the
+    # survivors ended up, leaves the map as moving them in turn would
+    killers = acting[killing]
+    victims = victims[killing]
+    survivors = acting[~killing]
+    survivors = survivors[~np.isin(survivors, victims)]
+    self.new_map.put(xs[acting], ys[acting], -1)
+    self.new_map.put(new_xs[killers], new_ys[killers], -1)
+    self.new_map.put(new_xs[survivors], new_ys[survivors], ids[survivors])
+    self.unit_pos.update(zip([units[i] for i in survivors.tolist()],
+        zip(new_xs[survivors].tolist(), new_ys[survivors].tolist())))
+    for i, victim in zip(killers.tolist(), victims.tolist()):
+      unit = units[i]
+      occupied = units[victim]
+      del self.unit_pos[unit]
+      del self.unit_pos[occupied]
+      self.killed.append(unit)
+      self.killed.append(occupied)
+      self.kills[unit.player.index] += 1
+      self.kills[occupied.player.index] += 1
+      self.losses[unit.player.index] += 1
+      self.losses[occupied.player.index] += 1
+
+  def spawn_phase(self):
+    for player in self.players:
+      if DEBUG["MOVES"] and player.index > 0:
+        continue
+      self.spawn(self.new_unit(player), player.spawnpoint)
+
+  def tick(self):
+    profiler = self.profiler
+    tick_start = profiler.start()
+    spawn_rate = 50 if DEBUG["MOVES"] else self.spawn_rate
+    if self.tick_no % spawn_rate == 0:
+      start = profiler.start()
+      self.spawn_phase()
+      profiler.stop("spawn_phase", start)
+    if self.tick_no % self.move_speed == 0:
+      start = profiler.start()
+      self.move_phase()
+      profiler.stop("move_phase", start)
+    start = profiler.start()
+    self.execute_moves()
+    profiler.stop("execute_moves", start)
+    if self.tick_no % self.event_speed == 0:
+      start = profiler.start()
+      self.expand_commands()
+      profiler.stop("expand_commands", start)
+    start = profiler.start()
+    self.deliver_events()
+    profiler.stop("deliver_events", start)
+    profiler.count("units", len(self.unit_pos))
+    profiler.stop("tick", tick_start)
+    self.tick_no += 1
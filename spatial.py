@@ -0,0 +1,100 @@
+import math
+
+class BucketGrid:
+  # units bucketed by square, so range queries only visit the buckets they
+  # overlap. buckets are tuples that get replaced rather than changed, so
+  # frozen() can hand out a copy that later updates won't touch
+  def __init__(self, bucket=8):
+    self.bucket = bucket
+    self.buckets = {}  # (bx, by) => tuple of (unit, position)
+    self.count = 0
+    self.extent = None  # (min bx, min by, max bx, max by) ever used
+
+  def key(self, pos):
+    return (pos[0] // self.bucket, pos[1] // self.bucket)
+
+  def add(self, unit, pos):
+    key = self.key(pos)
+    self.buckets[key] = self.buckets.get(key, ()) + ((unit, pos),)
+    self.count += 1
+    if self.extent is None:
+      self.extent = key + key
+    else:
+      x0, y0, x1, y1 = self.extent
+      self.extent = (min(x0, key[0]), min(y0, key[1]), max(x1, key[0]), max(y1, key[1]))
+
+  def remove(self, unit, pos):
+    key = self.key(pos)
+    entries = tuple(entry for entry in self.buckets.get(key, ()) if entry[0] != unit)
+    self.count -= len(self.buckets.get(key, ())) - len(entries)
+    if entries:
+      self.buckets[key] = entries
+    else:
+      self.buckets.pop(key, None)
+
+  def frozen(self):
+    copy = BucketGrid(self.bucket)
+    copy.buckets = dict(self.buckets)
+    copy.count = self.count
+    copy.extent = self.extent
+    return copy
+
+  def __len__(self):
+    return self.count
+
+  def __iter__(self):
+    for entries in self.buckets.values():
+      yield from entries
+
+  def query_rect(self, x0, y0, x1, y1):
+    # (unit, position) for everything with x0 <= x < x1 and y0 <= y < y1
+    if x0 >= x1 or y0 >= y1:
+      return []
+    hits = []
+    bx0, by0 = self.key((x0, y0))
+    bx1, by1 = self.key((x1 - 1, y1 - 1))
+    for bx in range(bx0, bx1 + 1):
+      for by in range(by0, by1 + 1):
+        for unit, pos in self.buckets.get((bx, by), ()):
+          if x0 <= pos[0] < x1 and y0 <= pos[1] < y1:
+            hits.append((unit, pos))
+    return hits
+
+  def query_radius(self, center, radius):
+    # (unit, position) for everything within radius of center
+    x, y = center
+    r = int(math.ceil(radius))
+    hits = []
+    for unit, pos in self.query_rect(x - r, y - r, x + r + 1, y + r + 1):
+      if (pos[0] - x) ** 2 + (pos[1] - y) ** 2 <= radius ** 2:
+        hits.append((unit, pos))
+    return hits
+
+  def nearest(self, center, match=None):
+    # closest (unit, position) to center, optionally only ones match() likes.
+    # looks at rings of buckets around center's and stops once no unseen
+    # bucket can hold anything closer
+    if self.extent is None:
+      return None
+    cx, cy = self.key(center)
+    x0, y0, x1, y1 = self.extent
+    max_ring = max(cx - x0, x1 - cx, cy - y0, y1 - cy)
+    best = None
+    best_d = None
+    for ring in range(max_ring + 1):
+      if best is not None and best_d <= ((ring - 1) * self.bucket) ** 2:
+        break
+      for bx in range(cx - ring, cx + ring + 1):
+        if abs(bx - cx) == ring:
+          column = range(cy - ring, cy + ring + 1)
+        else:
+          column = (cy - ring, cy + ring)
+        for by in column:
+          for unit, pos in self.buckets.get((bx, by), ()):
+            if match is not None and not match(unit):
+              continue
+            d = (pos[0] - center[0]) ** 2 + (pos[1] - center[1]) ** 2
+            if best is None or d < best_d:
+              best = (unit, pos)
+              best_d = d
+    return best